@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Materialized daily allocation per consent in a local sqlite file, filled incrementally from allo_ts by consent and date.
+"""
+import sqlite3
+import threading
+import pandas as pd
+import util
+from dbpool import rd_sql
+from util import crc_wap_table
+
+##########################################
+### Parameters
+
+## Files from before the unique index may hold duplicate days, which are dropped first
+create_stmts = ['CREATE TABLE IF NOT EXISTS allo_daily (crc TEXT, date TEXT, allo REAL)',
+                'DROP INDEX IF EXISTS ix_allo_daily',
+                'DELETE FROM allo_daily WHERE rowid NOT IN (SELECT MIN(rowid) FROM allo_daily GROUP BY crc, date)',
+                'CREATE UNIQUE INDEX IF NOT EXISTS ux_allo_daily ON allo_daily (crc, date)',
+                'CREATE TABLE IF NOT EXISTS allo_coverage (crc TEXT PRIMARY KEY, from_date TEXT, to_date TEXT)',
+                'CREATE TABLE IF NOT EXISTS crc_fingerprint (crc TEXT PRIMARY KEY, fingerprint TEXT)']
+
+## Seconds to wait for another process filling the same file
+lock_timeout = 600
+
+##########################################
+### Classes
+
+
+class AlloCache(object):
+    """
+    Daily allocation (daily volume summed per consent and date) materialized in a sqlite file. Each consent covers one contiguous date range; requests only run allo_ts for the consents and dates outside it. A consent's rows are dropped when its CrcWapAllo records change. Each fill holds the file's write lock from the coverage read to the commit, so several processes can share one file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            for stmt in create_stmts:
+                con.execute(stmt)
+            con.execute('COMMIT')
+        finally:
+            con.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=lock_timeout, isolation_level=None)
+
+    def _load_crcs(self, con, crcs):
+        con.execute('CREATE TEMP TABLE IF NOT EXISTS req_crc (crc TEXT PRIMARY KEY)')
+        con.execute('DELETE FROM req_crc')
+        con.executemany('INSERT OR IGNORE INTO req_crc VALUES (?)', [(c,) for c in crcs])
+
+    def _invalidate(self, con, crcs):
+        con.executemany('DELETE FROM allo_daily WHERE crc = ?', [(c,) for c in crcs])
+        con.executemany('DELETE FROM allo_coverage WHERE crc = ?', [(c,) for c in crcs])
+
+    def _check_fingerprints(self, con, server, database, crcs):
+        """
+        Drop the consents whose CrcWapAllo rows changed since they were materialized.
+        """
+        rows = rd_sql(server, database, crc_wap_table, where_in={'crc': crcs})
+        if rows.empty:
+            fp = pd.Series('0', index=pd.Index(crcs, name='crc'))
+        else:
+            hash1 = pd.util.hash_pandas_object(rows.astype(str), index=False)
+            fp = hash1.groupby(rows['crc'].values).sum().astype(str).reindex(crcs).fillna('0')
+
+        old_fp = pd.read_sql('SELECT f.crc, f.fingerprint FROM crc_fingerprint f JOIN req_crc r ON f.crc = r.crc', con).set_index('crc')['fingerprint']
+        changed = [c for c in old_fp.index if old_fp[c] != fp[c]]
+        if changed:
+            self._invalidate(con, changed)
+
+        con.executemany('INSERT OR REPLACE INTO crc_fingerprint VALUES (?, ?)', list(fp.items()))
+
+    def daily_allo(self, server, database, crcs, from_date, to_date):
+        """
+        DataFrame of crc, date and allo (daily volume) for the consents between from_date and to_date.
+        """
+        crcs = sorted(set(crcs))
+        from_date = pd.Timestamp(from_date).floor('D')
+        to_date = pd.Timestamp(to_date).floor('D')
+        one_day = pd.Timedelta(days=1)
+
+        with self._lock:
+            con = self._connect()
+            try:
+                con.execute('BEGIN IMMEDIATE')
+                self._load_crcs(con, crcs)
+                self._check_fingerprints(con, server, database, crcs)
+
+                ## Work out the missing date spans of each consent
+                cov = pd.read_sql('SELECT c.crc, c.from_date, c.to_date FROM allo_coverage c JOIN req_crc r ON c.crc = r.crc', con, parse_dates=['from_date', 'to_date']).set_index('crc')
+                spans = {}
+                new_cov = []
+                for crc in crcs:
+                    if crc in cov.index:
+                        cf, ct = cov.loc[crc, 'from_date'], cov.loc[crc, 'to_date']
+                        if from_date < cf:
+                            spans.setdefault((from_date, cf - one_day), []).append(crc)
+                        if to_date > ct:
+                            spans.setdefault((ct + one_day, to_date), []).append(crc)
+                        new_cov.append((crc, min(from_date, cf), max(to_date, ct)))
+                    else:
+                        spans.setdefault((from_date, to_date), []).append(crc)
+                        new_cov.append((crc, from_date, to_date))
+
+                ## Run the allocation engine only for the missing spans
+                for (f, t), span_crcs in spans.items():
+                    allo1 = util.allo_ts(server, str(f.date()), str(t.date()), 'D', 'daily volume', crc_filter={'crc': span_crcs}).reset_index()
+                    allo2 = allo1.groupby(['crc', 'date'])['allo'].sum().reset_index()
+                    allo2['date'] = pd.to_datetime(allo2['date']).dt.strftime('%Y-%m-%d')
+                    con.executemany('INSERT OR REPLACE INTO allo_daily VALUES (?, ?, ?)', list(allo2[['crc', 'date', 'allo']].itertuples(index=False, name=None)))
+
+                con.executemany('INSERT OR REPLACE INTO allo_coverage VALUES (?, ?, ?)', [(c, str(f.date()), str(t.date())) for c, f, t in new_cov])
+                con.execute('COMMIT')
+
+                allo3 = pd.read_sql('SELECT a.crc, a.date, a.allo FROM allo_daily a JOIN req_crc r ON a.crc = r.crc WHERE a.date >= ? AND a.date <= ?', con, params=(str(from_date.date()), str(to_date.date())))
+            except Exception:
+                if con.in_transaction:
+                    con.execute('ROLLBACK')
+                raise
+            finally:
+                con.close()
+
+        allo3['date'] = pd.to_datetime(allo3['date'])
+
+        return allo3
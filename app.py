@@ -2,15 +2,22 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash_table
 import plotly
 import plotly.graph_objs as go
+import io
+import os
 import pandas as pd
 import numpy as np
-from pdsql import mssql
-from util import app_ts_summ, sel_ts_summ, ecan_ts_data, lf_site_summ, app_allo_usage_summ, ecan_ts_summ
-import urllib
+from flask import Response, request, abort, jsonify
+from dbpool import rd_sql
+from util import app_ts_summ, sel_ts_summ, ecan_ts_data, lf_site_summ, app_allo_usage_summ, ecan_ts_summ, lf_site_band_table, site_types, data_source, restr_type, date_to_days, expand_summ, site_date_index, downsample_steps, ExceedanceRanking
+from snapshot import SnapshotScheduler, build_snapshot, snapshot_age_text
+from store import DataStore, SharedStore, make_key, split_key
+from urllib.parse import urlencode
+import util
+import metrics
 
 pd.options.display.max_columns = 10
 
@@ -18,16 +25,15 @@ pd.options.display.max_columns = 10
 app = dash.Dash(__name__)
 server = app.server
 
+metrics.instrument_callbacks(app)
+metrics.register_route(app.server)
+
 ##########################################
 ### Parameters
 
 server = 'edwprod01'
 database = 'hydro'
 
-site_types = ['LowFlow', 'Residual']
-data_source = ['Telemetered', 'Correlated from Telem', 'Gauged', 'Manually Calculated', 'GW manual']
-restr_type = ['No', 'Partial', 'Full', 'Deactivated']
-
 dataset_dict = {'features': ['River', 'Aquifer'],
                 'mtypes': ['Abstraction'],
                 'ctypes': ['Recorder'],
@@ -35,14 +41,39 @@ dataset_dict = {'features': ['River', 'Aquifer'],
                 'data_providers': ['ECan']}
 
 ts_plot_height = 600
+ts_point_budget = 2000
 map_height = 700
 
+snapshot_interval = 600
+
+## Last known good snapshot, served at startup until the first rebuild finishes
+snapshot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot.pkl')
+
+store_max_items = 32
+store_spill_dir = None
+
+## Directory of the cache shared by all worker processes on the node
+shared_cache_dir = None
+
+usage_mirror_path = None
+allo_cache_path = None
+
 #default_band_options = [{'value:': 'All Bands', 'label': 'All Bands'}]
 
 default_colors = plotly.colors.DEFAULT_PLOTLY_COLORS
 
 restr_color_dict = {'No': 'rgb(44, 160, 44)', 'Partial': 'rgb(255, 127, 14)', 'Full': 'rgb(214, 39, 40)', 'Deactivated': 'rgb(31, 119, 180)'}
 
+table_page_size = 50
+
+csv_chunk_rows = 10000
+
+## Store loaders that can be downloaded, and the longest date range of a download
+download_names = ['lf_site_summ', 'band_ts']
+download_max_days = 3660
+
+exceed_top_n = 20
+
 table_cols = ['ExtSiteID', 'ExtSiteName', 'NZTMX', 'NZTMY', 'Date', 'Site type', 'Data source', 'Days since last estimate', 'Flow or water level', 'Crc count', 'Min trigger', 'Max trigger', 'Restriction category']
 
 lat1 = -43.45
@@ -54,25 +85,77 @@ mapbox_access_token = "pk.eyJ1IjoibXVsbGVua2FtcDEiLCJhIjoiY2pwbHloa2ZwMDA2cTQybz
 ###############################################
 ### App layout
 
+if usage_mirror_path is not None:
+    from mirror import UsageMirror
+    util.usage_mirror = UsageMirror(usage_mirror_path)
+
+if allo_cache_path is not None:
+    from allo_cache import AlloCache
+    util.allo_cache = AlloCache(allo_cache_path)
+
+exceedances = ExceedanceRanking()
+
+shared_store = None
+if shared_cache_dir is not None:
+    shared_store = SharedStore(shared_cache_dir)
+
+
+def build_default():
+    snap = build_snapshot(server, database, dataset_dict, shared=shared_store, max_age=snapshot_interval)
+    exceedances.update(snap.allo_usage)
+    return snap
+
+
+snapshots = SnapshotScheduler(build_default, snapshot_interval, snapshot_path)
+last_snap = snapshots.load()
+if last_snap is not None:
+    exceedances.update(last_snap.allo_usage)
+
+
+
+def range_max_age(from_date, to_date):
+    """
+    Seconds a stored frame of a date range is kept. Ranges reaching into the last lf_immutable_days can still change and are reloaded after lf_refresh_age.
+    """
+    if pd.Timestamp(to_date) >= (pd.Timestamp.now().floor('D') - pd.Timedelta(days=util.lf_immutable_days)):
+        return util.lf_refresh_age
+    return None
+
+
+data_store = DataStore(store_max_items, store_spill_dir, shared_store)
+data_store.register('lf_site_summ', lambda from_date, to_date: lf_site_summ(server, database, from_date, to_date), range_max_age)
+data_store.register('ecan_ts_summ', lambda: ecan_ts_summ(server, database, **dataset_dict), snapshot_interval)
+data_store.register('site_band_ts', lambda site, from_date, to_date: rd_sql(server, database, lf_site_band_table, where_in={'site': [site]}, from_date=from_date, to_date=to_date, date_col='date'), lambda site, from_date, to_date: range_max_age(from_date, to_date))
+data_store.register('band_ts', lambda sites, bands, from_date, to_date: select_bands(site_band_ts(sites.split(','), from_date, to_date), [int(b) for b in bands.split(',') if b]), lambda sites, bands, from_date, to_date: range_max_age(from_date, to_date))
+data_store.register('app_allo_usage_summ', lambda from_date, to_date: app_allo_usage_summ(server, database, from_date, to_date, data_store.get(make_key('lf_site_summ', from_date, to_date)), data_store.get(make_key('ecan_ts_summ'))), range_max_age)
+
 map_layout = dict(mapbox = dict(layers = [], accesstoken = mapbox_access_token, style = 'outdoors', center=dict(lat=lat1, lon=lon1), zoom=zoom1), margin = dict(r=0, l=0, t=0, b=0), autosize=True, hovermode='closest', height=map_height, showlegend=True, legend=dict(x=0, y=1, traceorder='normal', font=dict(family='sans-serif', size=12, color='#000'), bgcolor='#E2E2E2', bordercolor='#FFFFFF', borderwidth=2))
 
 def serve_layout():
 
-    ### prepare summaries and initial states
-    to_date = pd.Timestamp.now()
-    from_date = to_date - pd.DateOffset(weeks=2)
+    ### prepare summaries and initial states from the latest snapshot, starting the refresh thread on the first page load
+    snapshots.start()
+    snap = snapshots.get()
+    to_date = snap.to_date
+    from_date = snap.from_date
 
-    ### Read in initial site summary data
-    init_summ = lf_site_summ(server, database, str(from_date.date()), str(to_date.date()))
+    init_summ = snap.lf_summ
 
     new_sites = init_summ.drop_duplicates('ExtSiteID')
 
-    usage_ts_summ = ecan_ts_summ(server, database, **dataset_dict)
+    usage_ts_summ = snap.usage_ts_summ
+
+    allo_usage1 = snap.allo_usage
 
-    allo_usage1 = app_allo_usage_summ(server, database, str(from_date.date()), str(to_date.date()), init_summ, usage_ts_summ)
+    from_str = str(from_date.date())
+    to_str = str(to_date.date())
+    lf_summ_key = data_store.put(make_key('lf_site_summ', from_str, to_str), init_summ)
+    usage_summ_key = data_store.put(make_key('ecan_ts_summ'), usage_ts_summ)
+    usage_ts_key = data_store.put(make_key('app_allo_usage_summ', from_str, to_str), allo_usage1)
 
     layout = html.Div(children=[
     html.Div([
+        html.P(children=snapshot_age_text(snap, snapshots.building, snapshots.last_error), id='snapshot-age', style={'fontSize': 'small'}),
         html.P(children='Filter sites by:'),
 		html.Label('Site Type'),
 		dcc.Dropdown(options=[{'label': d, 'value': d} for d in site_types], multi=True, value='LowFlow', id='site-type'),
@@ -91,7 +174,9 @@ def serve_layout():
         html.Label('Site IDs'),
 		dcc.Dropdown(options=[{'label': d, 'value': d} for d in new_sites.ExtSiteID.sort_values()], multi=True, id='sites-dropdown'),
         html.Label('Consent Numbers'),
-		dcc.Dropdown(options=[{'label': d, 'value': d} for d in allo_usage1.crc.sort_values().unique()], multi=True, id='crc-dropdown')
+		dcc.Dropdown(options=[{'label': d, 'value': d} for d in allo_usage1.crc.sort_values().unique()], multi=True, id='crc-dropdown'),
+        html.Label('Download Format'),
+        dcc.RadioItems(options=[{'label': 'csv', 'value': 'csv'}, {'label': 'parquet', 'value': 'parquet'}], value='csv', id='download-format')
 		], className='two columns', style={'margin': 20}),
 
 	html.Div([
@@ -118,17 +203,21 @@ def serve_layout():
         html.A(
             'Download Site Summary Data',
             id='download-summ',
-            download="site_summary.csv",
             href="",
             target="_blank",
             style={'margin': 50}),
 
         dash_table.DataTable(
             id='summ_table',
-            columns=[{"name": i, "id": i, 'deletable': True} for i in init_summ.columns],
-            data=init_summ.astype(str).to_dict('rows'),
-            sorting=True,
+            columns=[{"name": i, "id": i, 'deletable': True} for i in table_cols],
+            data=table_page(init_summ, None, None, None, None),
+            pagination_mode='be',
+            pagination_settings={'current_page': 0, 'page_size': table_page_size},
+            sorting='be',
             sorting_type="multi",
+            sorting_settings=[],
+            filtering='be',
+            filtering_settings='',
             style_cell={
                 'minWidth': '80px', 'maxWidth': '200px',
                 'whiteSpace': 'normal'
@@ -164,14 +253,23 @@ def serve_layout():
         html.A(
             'Download Time Series Data',
             id='download-tsdata',
-            download="tsdata.csv",
             href="",
             target="_blank",
-            style={'margin': 50})
+            style={'margin': 50}),
+        html.P('Consents with the highest latest usage/allocation:'),
+        dash_table.DataTable(
+            id='exceed_table',
+            columns=[{"name": i, "id": i} for i in ['crc', 'date', 'usage/allo', 'Usage', 'allo']],
+            data=exceed_rows(exceed_top_n),
+            style_cell={
+                'minWidth': '80px', 'maxWidth': '200px',
+                'whiteSpace': 'normal'
+            })
 	], className='six columns', style={'margin': 10, 'height': 900}),
-    html.Div(id='lf_summ_data', style={'display': 'none'}, children=init_summ.to_json(date_format='iso', orient='split')),
-    html.Div(id='usage_summ_data', style={'display': 'none'}, children=usage_ts_summ.to_json(date_format='iso', orient='split')),
-    html.Div(id='usage_ts_data', style={'display': 'none'}, children=allo_usage1.to_json(date_format='iso', orient='split')),
+    html.Div(id='lf_summ_data', style={'display': 'none'}, children=lf_summ_key),
+    html.Div(id='usage_summ_data', style={'display': 'none'}, children=usage_summ_key),
+    html.Div(id='usage_ts_data', style={'display': 'none'}, children=usage_ts_key),
+    dcc.Store(id='site-geometry'),
     dcc.Graph(id='map-layout', style={'display': 'none'}, figure=dict(data=[], layout=map_layout))
 ], style={'margin':0})
 
@@ -187,84 +285,64 @@ app.css.append_css({'external_url': 'https://codepen.io/plotly/pen/EQZeaW.css'})
 
 
 @app.callback(
-    Output('summ_data', 'children'), [Input('date_sel', 'start_date'), Input('date_sel', 'end_date')])
+    Output('lf_summ_data', 'children'), [Input('date_sel', 'start_date'), Input('date_sel', 'end_date')])
 def store_summ(start_date, end_date):
-#    ts_summ['FromDate'] = pd.to_datetime(ts_summ['FromDate'])
-#    ts_summ['ToDate'] = pd.to_datetime(ts_summ['ToDate'])
-    new_summ = lf_site_summ(server, database, start_date, end_date)
-    print('store_summ', start_date, end_date)
-    return new_summ.to_json(date_format='iso', orient='split')
+    return data_store.get_or_load('lf_site_summ', start_date, end_date)
 
 
-@app.callback(
-		Output('map-layout', 'figure'),
-		[Input('site-map', 'relayoutData')],
-		[State('map-layout', 'figure')])
-def update_map_layout(relay, figure):
-    if relay is not None:
-#        print(figure['layout'])
-        if 'mapbox.center' in relay:
-#            print(relay)
-            lat = float(relay['mapbox.center']['lat'])
-            lon = float(relay['mapbox.center']['lon'])
-            zoom = float(relay['mapbox.zoom'])
-            new_layout = figure['layout'].copy()
-            new_layout['mapbox']['zoom'] = zoom
-            new_layout['mapbox']['center']['lat'] = lat
-            new_layout['mapbox']['center']['lon'] = lon
-        else:
-            new_layout = figure['layout'].copy()
-    else:
-        new_layout = figure['layout'].copy()
-
-    return dict(data=[], layout=new_layout)
+app.clientside_callback(
+    ClientsideFunction('lowflows', 'update_map_layout'),
+    Output('map-layout', 'figure'),
+    [Input('site-map', 'relayoutData')],
+    [State('map-layout', 'figure')])
 
 
 @app.callback(
-		Output('site-map', 'figure'),
-		[Input('summ_data', 'children'), Input('site-type', 'value'), Input('data-source', 'value'), Input('restr-type', 'value')],
-		[State('map-layout', 'figure'), State('date_sel', 'end_date')])
-def display_map(summ_data, site_type, data_source, restr_type, figure, end_date):
-    if isinstance(site_type, str):
-        site_type = [site_type]
-    if isinstance(data_source, str):
-        data_source = [data_source]
-    if isinstance(restr_type, str):
-        restr_type = [restr_type]
-
-    new_summ = pd.read_json(summ_data, orient='split')
-    new_sites = new_summ[(new_summ['Date'] == end_date) & (new_summ['Site type'].isin(site_type)) & (new_summ['Data source'].isin(data_source)) & (new_summ['Restriction category'].isin(restr_type))].drop_duplicates('ExtSiteID')
-#    print(new_sites)
-#    print(new_summ.ExtSiteID.unique())
-
-    data = []
-    for r in restr_type:
-        sub_sites = new_sites[new_sites['Restriction category'] == r]
-        subset = dict(
-    		lat = sub_sites['lat'],
-    		lon = sub_sites['lon'],
-    		text = sub_sites['hover'],
-    		type = 'scattermapbox',
-    		hoverinfo = 'text',
-    		marker = dict(size=10, color=restr_color_dict[r], opacity=1),
-            name = r
-            )
-        data.append(subset)
-
-    fig = dict(data=data, layout=figure['layout'])
-    return fig
+		Output('site-geometry', 'data'),
+		[Input('lf_summ_data', 'children'), Input('date_sel', 'end_date')])
+def site_geometry(summ_key, end_date):
+    new_summ = data_store.get(summ_key)
+    index1 = site_date_index(new_summ)
+    date1 = date_to_days(end_date)
+
+    return index1.memo(('geometry', date1), lambda: geometry_data(new_summ, index1.positions(date1)))
+
+
+def geometry_data(summ, pos):
+    """
+    Column lists of the sites at the row positions of the summary, with one entry per site and filter combination. The browser filters them into the map traces.
+    """
+    cols = ['ExtSiteID', 'Site type', 'Data source', 'Restriction category']
+    sites = summ.iloc[pos].drop_duplicates(cols)
+    return dict(
+        site = sites['ExtSiteID'].astype(str).tolist(),
+        lat = sites['lat'].tolist(),
+        lon = sites['lon'].tolist(),
+        text = sites['hover'].tolist(),
+        site_type = sites['Site type'].astype(str).tolist(),
+        data_source = sites['Data source'].astype(str).tolist(),
+        restr = sites['Restriction category'].astype(str).tolist(),
+        colors = restr_color_dict
+        )
+
+
+app.clientside_callback(
+    ClientsideFunction('lowflows', 'display_map'),
+    Output('site-map', 'figure'),
+    [Input('site-geometry', 'data'), Input('site-type', 'value'), Input('data-source', 'value'), Input('restr-type', 'value')],
+    [State('map-layout', 'figure')])
 
 
 @app.callback(
     Output('sel-dropdown', 'options'),
-    [Input('sites-dropdown', 'value'), Input('site-map', 'clickData'), Input('select1', 'value')],
-    [State('date_sel', 'end_date')])
-def update_band_options(sites, clickdata, end_date, select1):
-    if not sites:
-        options1 = []
-    elif select1 == 'band':
+    [Input('sites-dropdown', 'value'), Input('select1', 'value')],
+    [State('date_sel', 'start_date'), State('date_sel', 'end_date')])
+def update_band_options(sites, select1, start_date, end_date):
+    options1 = []
+    if sites and select1 == 'band':
         sites1 = [str(s) for s in sites]
-        site_bands = mssql.rd_sql(server, db, lf_site_band_table, ['band_num', 'band_name', 'site_type'], where_col={'site': sites1}, from_date=end_date, to_date=end_date, date_col='date').drop_duplicates(['band_name'])
+        ts1 = site_band_ts(sites1, start_date, end_date)
+        site_bands = ts1.loc[pd.to_datetime(ts1['date']) == pd.Timestamp(end_date), ['band_num', 'band_name', 'site_type']].drop_duplicates(['band_name'])
         site_bands['label'] = site_bands['band_name'] + ' - ' + site_bands['site_type']
         site_bands1 = site_bands.rename(columns={'band_num': 'value'}).drop(['band_name', 'site_type'], axis=1)
         options1 = site_bands1.to_dict('records')
@@ -277,36 +355,26 @@ def update_band_options(sites, clickdata, end_date, select1):
 
 @app.callback(
         Output('sites-dropdown', 'options'),
-        [Input('summ_data', 'children')])
-def update_sites_options(summ_data):
-    new_summ = pd.read_json(summ_data, orient='split')
-    sites = np.sort(new_summ.ExtSiteID.unique())
+        [Input('lf_summ_data', 'children')])
+def update_sites_options(summ_key):
+    new_summ = data_store.get(summ_key)
+    sites = np.sort(new_summ.ExtSiteID.astype(str).unique())
     options1 = [{'label': i, 'value': i} for i in sites]
     return options1
 
 
-@app.callback(
-        Output('sites-dropdown', 'value'),
-        [Input('site-map', 'selectedData'), Input('site-map', 'clickData')])
-def update_sites_values(selectedData, clickData):
-    if selectedData is not None:
-        sites1 = [s['text'].split('<br>')[0] for s in selectedData['points']]
-        print(sites1)
-    elif clickData is not None:
-        sites1 = [clickData['points'][0]['text'].split('<br>')[0]]
-        print(sites1)
-    else:
-        sites1 = []
-    return sites1[:1]
+app.clientside_callback(
+    ClientsideFunction('lowflows', 'update_sites_values'),
+    Output('sites-dropdown', 'value'),
+    [Input('site-map', 'selectedData'), Input('site-map', 'clickData')])
 
 
 @app.callback(
 	Output('selected-data', 'figure'),
-	[Input('sites-dropdown', 'value'), Input('band-dropdown', 'value'), Input('date_sel', 'start_date'), Input('date_sel', 'end_date')])
-def display_data(sites, bands, start_date, end_date):
+	[Input('sites-dropdown', 'value'), Input('sel-dropdown', 'value'), Input('date_sel', 'start_date'), Input('date_sel', 'end_date'), Input('selected-data', 'relayoutData')])
+def display_data(sites, bands, start_date, end_date, relay):
 
-    print(sites, bands, start_date, end_date)
-    if not sites or bands is None:
+    if not sites or not bands:
         return dict(
 			data = [dict(x=0, y=0)],
 			layout = dict(
@@ -338,7 +406,7 @@ def display_data(sites, bands, start_date, end_date):
             )
 
 #    if bands is None:
-#        ts1 = mssql.rd_sql(server, db, lf_site_band_table, ['date', 'flow'], where_col={'site': sites1}, from_date=start_date, to_date=end_date, date_col='date')
+#        ts1 = rd_sql(server, database, lf_site_band_table, ['date', 'flow'], where_in={'site': sites1}, from_date=start_date, to_date=end_date, date_col='date')
 #        flow_data = ts1[['date', 'flow']].drop_duplicates('date')
 #        data = [go.Scattergl(
 #                    x=flow_data.date,
@@ -352,22 +420,36 @@ def display_data(sites, bands, start_date, end_date):
     if isinstance(bands, int):
         bands = [bands]
 
-    ts1 = mssql.rd_sql(server, db, lf_site_band_table, ['date', 'band_name', 'flow', 'min_trig', 'max_trig', 'band_allo'], where_col={'site': sites1, 'band_num': bands}, from_date=start_date, to_date=end_date, date_col='date')
+    ts1 = data_store.get(band_key(sites1, bands, start_date, end_date))[['date', 'band_name', 'flow', 'min_trig', 'max_trig', 'band_allo']].copy()
+    ts1['date'] = pd.to_datetime(ts1['date'])
+    ts1 = ts1.sort_values('date')
+
+    ## Only plot the zoomed range at full resolution. A zoom left over from another site, band or date selection is ignored
+    if relay is not None and 'xaxis.range[0]' in relay and triggered_by('selected-data.relayoutData'):
+        zoom_start = max(pd.Timestamp(relay['xaxis.range[0]']), pd.Timestamp(start_date))
+        zoom_end = min(pd.Timestamp(relay['xaxis.range[1]']), pd.Timestamp(end_date) + pd.Timedelta(days=1))
+        if zoom_start < zoom_end:
+            layout['xaxis'] = dict(range=[str(zoom_start), str(zoom_end)])
+            ts1 = ts1[(ts1['date'] >= zoom_start.floor('D')) & (ts1['date'] <= zoom_end.ceil('D'))]
 
     color_dict = dict(zip(ts1.band_name.unique().tolist(), default_colors))
 
     flow_data = ts1[['date', 'flow']].drop_duplicates('date')
+    flow_x, flow_y = downsample_steps(flow_data.date, flow_data.flow, ts_point_budget)
     data = [go.Scattergl(
-                x=flow_data.date,
-                y=flow_data.flow,
+                x=flow_x,
+                y=flow_y,
                 legendgroup='flow',
                 name='Flow',
                 line={'color': 'black', 'shape': 'hv'},
                 opacity=1)]
     for name, group in ts1.groupby('band_name'):
+        min_x, min_y = downsample_steps(group.date, group.min_trig, ts_point_budget)
+        max_x, max_y = downsample_steps(group.date, group.max_trig, ts_point_budget)
+        allo_x, allo_y = downsample_steps(group.date, group.band_allo, ts_point_budget)
         min_trig = go.Scattergl(
-                x=group.date,
-                y=group.min_trig,
+                x=min_x,
+                y=min_y,
                 legendgroup=name,
                 name='Min Trigger, ' + name,
                 mode='lines',
@@ -375,8 +457,8 @@ def display_data(sites, bands, start_date, end_date):
                 opacity=0.7,
                 yaxis='y1')
         max_trig = go.Scattergl(
-                x=group.date,
-                y=group.max_trig,
+                x=max_x,
+                y=max_y,
                 legendgroup=name,
                 name='Max Trigger, ' + name,
                 mode='lines',
@@ -384,8 +466,8 @@ def display_data(sites, bands, start_date, end_date):
                 opacity=0.7,
                 yaxis='y1')
         allo = go.Scattergl(
-                x=group.date,
-                y=group.band_allo,
+                x=allo_x,
+                y=allo_y,
                 legendgroup=name,
                 name='Allowed Allocation %, ' + name,
                 line=dict(color=color_dict[name], shape='hv'),
@@ -406,21 +488,17 @@ def display_data(sites, bands, start_date, end_date):
 
 @app.callback(
     Output('summ_table', 'data'),
-    [Input('summ_data', 'children'), Input('sites-dropdown', 'value'), Input('site-map', 'selectedData'), Input('site-map', 'clickData')])
-def plot_table(summ_data, sites, selectedData, clickData):
-    new_summ = pd.read_json(summ_data, orient='split')[table_cols]
-
-    if sites:
-        new_summ = new_summ.loc[new_summ.ExtSiteID.isin(sites)]
-    return new_summ.to_dict("rows")
+    [Input('lf_summ_data', 'children'), Input('sites-dropdown', 'value'), Input('summ_table', 'pagination_settings'), Input('summ_table', 'sorting_settings'), Input('summ_table', 'filtering_settings')])
+def plot_table(summ_key, sites, pagination_settings, sorting_settings, filtering_settings):
+    return table_page(data_store.get(summ_key), sites, pagination_settings, sorting_settings, filtering_settings)
 
 
 @app.callback(
     Output('download-tsdata', 'href'),
-    [Input('sites-dropdown', 'value'), Input('band-dropdown', 'value'), Input('date_sel', 'start_date'), Input('date_sel', 'end_date')])
-def download_tsdata(sites, bands, start_date, end_date):
+    [Input('sites-dropdown', 'value'), Input('sel-dropdown', 'value'), Input('date_sel', 'start_date'), Input('date_sel', 'end_date'), Input('download-format', 'value')])
+def download_tsdata(sites, bands, start_date, end_date, fmt):
 
-    if not sites or bands is None:
+    if not sites or not bands:
         return ''
 
     sites1 = [str(s) for s in sites]
@@ -428,22 +506,179 @@ def download_tsdata(sites, bands, start_date, end_date):
     if isinstance(bands, int):
         bands = [bands]
 
-    ts1 = mssql.rd_sql(server, db, lf_site_band_table, where_col={'site': sites1, 'band_num': bands}, from_date=start_date, to_date=end_date, date_col='date')
-
-    csv_string = ts1.to_csv(index=False, encoding='utf-8')
-    csv_string = "data:text/csv;charset=utf-8," + urllib.parse.quote(csv_string)
-    return csv_string
+    return '/download/data?' + urlencode({'key': band_key(sites1, bands, start_date, end_date), 'name': 'tsdata', 'format': fmt})
 
 
 @app.callback(
     Output('download-summ', 'href'),
-    [Input('summ_data', 'children')])
-def download_summ(summ_data):
-    new_summ = pd.read_json(summ_data, orient='split')
+    [Input('lf_summ_data', 'children'), Input('download-format', 'value')])
+def download_summ(summ_key, fmt):
+    return '/download/data?' + urlencode({'key': summ_key, 'name': 'site_summary', 'format': fmt})
+
+
+def exceed_rows(n):
+    """
+    The top n rows of the exceedance ranking as records.
+    """
+    top1 = exceedances.top(n)
+    top1['date'] = top1['date'].dt.strftime('%Y-%m-%d')
+    top1['usage/allo'] = top1['usage/allo'].round(3)
+    return top1.to_dict('records')
+
+
+@app.server.route('/api/exceedances')
+def api_exceedances():
+    """
+    The consents with the highest latest usage/allocation as json. The number of consents is set with the n argument.
+    """
+    n = request.args.get('n', exceed_top_n, type=int)
+    return jsonify(exceed_rows(n))
+
+
+def triggered_by(prop_id):
+    """
+    Whether the running callback was triggered by prop_id ('component-id.property'). False outside of a Dash request.
+    """
+    try:
+        triggered = dash.callback_context.triggered
+    except (RuntimeError, dash.exceptions.DashException):
+        return False
+    return any(t['prop_id'] == prop_id for t in triggered)
+
+
+def band_key(sites, bands, start_date, end_date):
+    """
+    Store key of the LowFlowRestrSiteBand rows of sites and bands between two dates.
+    """
+    return make_key('band_ts', ','.join(sites), ','.join(str(b) for b in bands), start_date, end_date)
+
+
+def site_band_ts(sites, start_date, end_date):
+    """
+    The LowFlowRestrSiteBand rows of all bands of sites between two dates. Each site is read once per date range and kept in the data store, so the band options, the plot and the download share it.
+    """
+    ts_list = [data_store.get(make_key('site_band_ts', s, start_date, end_date)) for s in sites]
+    return pd.concat(ts_list, ignore_index=True)
+
+
+def select_bands(ts, bands):
+    """
+    The rows of a site band frame for a list of band numbers.
+    """
+    return ts[ts['band_num'].isin(bands)].reset_index(drop=True)
+
+
+def csv_chunks(df, chunk_rows=csv_chunk_rows):
+    """
+    Generate the csv of a frame in chunks of rows, converting compact summary columns on the way.
+    """
+    yield expand_summ(df.iloc[:0]).to_csv(index=False)
+    for i in range(0, len(df), chunk_rows):
+        yield expand_summ(df.iloc[i:i + chunk_rows]).to_csv(index=False, header=False)
+
+
+def valid_download_key(key):
+    """
+    Whether a store key is one of the download_names with valid parameters and a date range of at most download_max_days.
+    """
+    name, params = split_key(key)
+    if name not in download_names or len(params) < 2:
+        return False
+    try:
+        from_date = pd.Timestamp(params[-2])
+        to_date = pd.Timestamp(params[-1])
+        if name == 'band_ts':
+            if len(params) != 4 or not params[0] or not params[1]:
+                return False
+            [int(b) for b in params[1].split(',')]
+        elif len(params) != 2:
+            return False
+    except ValueError:
+        return False
+    return from_date <= to_date and (to_date - from_date).days <= download_max_days
+
+
+@app.server.route('/download/data')
+def download_data():
+    """
+    Download a stored frame as csv (streamed) or parquet. The frame comes from the same data store the plots use and is only read when the link is clicked. Only the download_names loaders can be requested.
+    """
+    key = request.args.get('key', '')
+    name = request.args.get('name', 'data')
+    fmt = request.args.get('format', 'csv')
+
+    if not valid_download_key(key) or fmt not in ('csv', 'parquet') or not name.replace('_', '').isalnum():
+        abort(400)
+
+    df = data_store.get(key)
+    if df is None:
+        abort(404)
+
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        buf = io.BytesIO()
+        pq.write_table(pa.Table.from_pandas(expand_summ(df), preserve_index=False), buf)
+        return Response(buf.getvalue(), mimetype='application/octet-stream', headers={'Content-Disposition': 'attachment; filename=' + name + '.parquet'})
+
+    return Response(csv_chunks(df), mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename=' + name + '.csv'})
+
+
+def filter_table(df, filtering_settings):
+    """
+    Apply a DataTable filtering expression ('{col} eq value && {col} > 5') to a compact summary frame.
+    """
+    for expr in filtering_settings.split(' && '):
+        for op in (' eq ', ' > ', ' < '):
+            if op not in expr:
+                continue
+            col, value = expr.split(op, 1)
+            col = col.strip().strip('{}"\'')
+            value = value.strip().strip('"\'')
+            if col not in df:
+                break
+            if col == 'Date':
+                values = df[col]
+                value = date_to_days(value)
+            elif op == ' eq ':
+                values = df[col].astype(str)
+            else:
+                values = pd.to_numeric(df[col].astype(object), errors='coerce')
+                value = float(value)
+            if op == ' eq ':
+                df = df[values == value]
+            elif op == ' > ':
+                df = df[values > value]
+            else:
+                df = df[values < value]
+            break
+    return df
+
+
+def table_page(summ, sites, pagination_settings, sorting_settings, filtering_settings):
+    """
+    Filter, sort and page the site summary on the server and return only the rows of the current page.
+    """
+    df = summ[table_cols]
+
+    if sites:
+        df = df[df.ExtSiteID.isin(sites)]
+
+    if filtering_settings:
+        try:
+            df = filter_table(df, filtering_settings)
+        except ValueError:
+            pass
+
+    if sorting_settings:
+        df = df.sort_values([s['column_id'] for s in sorting_settings], ascending=[s['direction'] == 'asc' for s in sorting_settings], kind='mergesort')
+
+    if pagination_settings is None:
+        pagination_settings = {'current_page': 0, 'page_size': table_page_size}
+    start1 = pagination_settings['current_page'] * pagination_settings['page_size']
+    page = df.iloc[start1:start1 + pagination_settings['page_size']]
 
-    csv_string = new_summ.to_csv(index=False, encoding='utf-8')
-    csv_string = "data:text/csv;charset=utf-8," + urllib.parse.quote(csv_string)
-    return csv_string
+    return expand_summ(page).astype(str).to_dict('rows')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+/*
+Clientside callbacks of the lowflows dashboard. The site geometry is sent once per summary and date, and the map filtering and bookkeeping run in the browser.
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    lowflows: {
+
+        // Map traces of the site geometry, one per restriction category, filtered by site type and data source
+        display_map: function(geometry, site_type, data_source, restr_type, figure) {
+            if (!geometry) {
+                return figure;
+            }
+            var as_list = function(v) {
+                if (v === null || v === undefined) {return [];}
+                return Array.isArray(v) ? v : [v];
+            };
+            var site_types = as_list(site_type);
+            var data_sources = as_list(data_source);
+            var data = as_list(restr_type).map(function(restr) {
+                var lat = [], lon = [], text = [], seen = {};
+                for (var i = 0; i < geometry.site.length; i++) {
+                    var site = geometry.site[i];
+                    if (geometry.restr[i] !== restr || seen[site] ||
+                        site_types.indexOf(geometry.site_type[i]) < 0 ||
+                        data_sources.indexOf(geometry.data_source[i]) < 0) {
+                        continue;
+                    }
+                    seen[site] = true;
+                    lat.push(geometry.lat[i]);
+                    lon.push(geometry.lon[i]);
+                    text.push(geometry.text[i]);
+                }
+                return {lat: lat, lon: lon, text: text, type: 'scattermapbox', hoverinfo: 'text',
+                        marker: {size: 10, color: geometry.colors[restr], opacity: 1}, name: restr};
+            });
+            return {data: data, layout: figure.layout};
+        },
+
+        // Keep the map zoom and center so a redraw of the sites does not reset them
+        update_map_layout: function(relay, figure) {
+            var layout = JSON.parse(JSON.stringify(figure.layout));
+            if (relay && relay['mapbox.center']) {
+                layout.mapbox.zoom = parseFloat(relay['mapbox.zoom']);
+                layout.mapbox.center.lat = parseFloat(relay['mapbox.center'].lat);
+                layout.mapbox.center.lon = parseFloat(relay['mapbox.center'].lon);
+            }
+            return {data: [], layout: layout};
+        },
+
+        // The site ID of the selected or clicked map point
+        update_sites_values: function(selectedData, clickData) {
+            var sites = [];
+            if (selectedData) {
+                sites = selectedData.points.map(function(p) {return p.text.split('<br>')[0];});
+            } else if (clickData) {
+                sites = [clickData.points[0].text.split('<br>')[0]];
+            }
+            return sites.slice(0, 1);
+        }
+    }
+});
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the summary functions and Dash callbacks against a synthetic sqlite stand-in for the hydro database.
+
+Usage: python bench.py --sites 500 --days 60 --consents 2000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import sqlite3
+import pandas as pd
+import numpy as np
+import dbpool
+from util import site_types, data_source, restr_type
+
+##########################################
+### Parameters
+
+server = 'edwprod01'
+database = 'hydro'
+
+usage_datasets = pd.DataFrame({'DatasetTypeID': [9, 12], 'Feature': ['River', 'Aquifer'], 'MeasurementType': ['Abstraction', 'Abstraction'], 'CollectionType': ['Recorder', 'Recorder'], 'DataCode': ['RAW', 'RAW'], 'DataProvider': ['ECan', 'ECan']})
+
+allo_table = 'AlloDaily'
+
+##########################################
+### Synthetic data
+
+
+def make_synthetic_db(path, n_sites=200, n_days=30, n_consents=1000, bands_per_site=2, seed=1):
+    """
+    Fill a sqlite database at path with synthetic ExternalSite, LowFlowRestrSite*, CrcWapAllo, TSDataNumericDaily(Summ) and dataset tables, plus an AlloDaily table with the daily allocation per consent. Dates are stored as YYYY-MM-DD text so the date filters of dbpool.rd_sql compare the same way as on SQL Server.
+    """
+    rs = np.random.RandomState(seed)
+
+    to_date = pd.Timestamp.now().floor('D')
+    dates = pd.date_range(to_date - pd.Timedelta(days=n_days - 1), to_date, freq='D')
+    date_str = dates.strftime('%Y-%m-%d')
+
+    ## Low flow sites
+    lf_sites = ['LF' + str(i).zfill(5) for i in range(n_sites)]
+    n_waps = max(n_consents, 1)
+    waps = ['W' + str(i).zfill(6) for i in range(n_waps)]
+
+    ext_sites = pd.DataFrame({'ExtSiteID': lf_sites + waps})
+    ext_sites['ExtSiteName'] = 'Site ' + ext_sites['ExtSiteID']
+    ext_sites['NZTMX'] = rs.randint(1350000, 1650000, len(ext_sites))
+    ext_sites['NZTMY'] = rs.randint(5000000, 5350000, len(ext_sites))
+
+    site_days = pd.MultiIndex.from_product([lf_sites, date_str], names=['site', 'date']).to_frame(index=False)
+    n1 = len(site_days)
+    site_days['site_type'] = np.array(site_types)[rs.randint(0, len(site_types), n1)]
+    site_days['flow_method'] = np.array(data_source)[rs.randint(0, len(data_source), n1)]
+    site_days['days_since_flow_est'] = rs.randint(0, 5, n1)
+    site_days['flow'] = rs.gamma(2, 5, n1).round(3)
+    site_days['crc_count'] = rs.randint(0, 50, n1)
+    site_days['min_trig'] = rs.uniform(1, 5, n1).round(3)
+    site_days['max_trig'] = site_days['min_trig'] + rs.uniform(1, 5, n1).round(3)
+    site_days['restr_category'] = np.array(restr_type)[rs.randint(0, len(restr_type), n1)]
+
+    ## Bands
+    bands = pd.MultiIndex.from_product([lf_sites, range(1, bands_per_site + 1), date_str], names=['site', 'band_num', 'date']).to_frame(index=False)
+    bands = pd.merge(bands, site_days[['site', 'date', 'site_type', 'flow', 'min_trig', 'max_trig']], on=['site', 'date'])
+    bands['band_name'] = 'Band ' + bands['band_num'].astype(str)
+    bands['band_allo'] = np.array([0, 50, 100])[rs.randint(0, 3, len(bands))]
+
+    ## Consents, waps and allocations
+    crcs = ['CRC' + str(i).zfill(6) for i in range(n_consents)]
+    crc_band = pd.DataFrame({'crc': crcs, 'site': np.array(lf_sites)[rs.randint(0, n_sites, n_consents)], 'band_num': rs.randint(1, bands_per_site + 1, n_consents)})
+    band_crc = pd.merge(crc_band.assign(key=1), pd.DataFrame({'date': date_str, 'key': 1}), on='key').drop('key', axis=1)
+
+    crc_wap = pd.DataFrame({'crc': np.repeat(crcs, 2), 'wap': np.array(waps)[rs.randint(0, n_waps, n_consents * 2)]}).drop_duplicates()
+
+    allo = pd.MultiIndex.from_product([crcs, date_str], names=['crc', 'date']).to_frame(index=False)
+    allo['allo'] = np.repeat(rs.uniform(100, 5000, n_consents), len(dates)).round(1)
+
+    ## Usage
+    used_waps = crc_wap['wap'].unique()
+    wap_dataset = pd.DataFrame({'ExtSiteID': used_waps, 'DatasetTypeID': usage_datasets['DatasetTypeID'].values[rs.randint(0, len(usage_datasets), len(used_waps))]})
+    usage = pd.MultiIndex.from_product([used_waps, date_str], names=['ExtSiteID', 'DateTime']).to_frame(index=False)
+    usage = pd.merge(usage, wap_dataset, on='ExtSiteID')
+    usage['Value'] = rs.gamma(2, 500, len(usage)).round(1)
+
+    usage_summ = usage.groupby(['ExtSiteID', 'DatasetTypeID'])['Value'].agg(['min', 'median', 'mean', 'max', 'count']).reset_index()
+    usage_summ.columns = ['ExtSiteID', 'DatasetTypeID', 'Min', 'Median', 'Mean', 'Max', 'Count']
+    usage_summ['FromDate'] = date_str[0]
+    usage_summ['ToDate'] = date_str[-1]
+
+    mtypes = pd.DataFrame({'MeasurementType': ['Abstraction'], 'Units': ['m**3']})
+    wq_mtypes = pd.DataFrame({'MeasurementID': pd.Series([], dtype='int64'), 'Measurement': pd.Series([], dtype=object)})
+
+    tables = {'ExternalSite': ext_sites,
+              'LowFlowRestrSite': site_days,
+              'LowFlowRestrSiteBand': bands,
+              'LowFlowRestrSiteBandCrc': band_crc,
+              'CrcWapAllo': crc_wap,
+              'TSDataNumericDaily': usage,
+              'TSDataNumericDailySumm': usage_summ,
+              'vDatasetTypeNamesActive': usage_datasets,
+              'MeasurementType': mtypes,
+              'WQMeasurement': wq_mtypes,
+              allo_table: allo}
+
+    con = sqlite3.connect(path)
+    try:
+        for name, df in tables.items():
+            df.to_sql(name, con, if_exists='replace', index=False)
+        con.execute('CREATE INDEX ix_lf_date ON LowFlowRestrSite (date)')
+        con.execute('CREATE INDEX ix_band_site ON LowFlowRestrSiteBand (site, date)')
+        con.execute('CREATE INDEX ix_ts ON TSDataNumericDaily (ExtSiteID, DateTime)')
+        con.commit()
+    finally:
+        con.close()
+
+    return {name: len(df) for name, df in tables.items()}
+
+
+def synthetic_allo_ts(server, from_date, to_date, freq, groupby, crc_filter=None, **kwargs):
+    """
+    Stand-in for allotools.allocation_ts.allo_ts that reads the precomputed AlloDaily table of the synthetic database.
+    """
+    where_in = None
+    if crc_filter is not None:
+        where_in = {'crc': crc_filter['crc']}
+    allo1 = dbpool.rd_sql(server, database, allo_table, ['crc', 'date', 'allo'], where_in=where_in, from_date=from_date, to_date=to_date, date_col='date')
+    allo1['date'] = pd.to_datetime(allo1['date'])
+    return allo1.set_index(['crc', 'date'])['allo']
+
+
+##########################################
+### Benchmarks
+
+
+def measure(name, func, *args, **kwargs):
+    """
+    Run func and return a dict of the wall time, peak traced memory and rows per second.
+    """
+    tracemalloc.start()
+    start1 = time.perf_counter()
+    result = func(*args, **kwargs)
+    secs = time.perf_counter() - start1
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        rows = len(result)
+    elif isinstance(result, (list, dict, str)):
+        rows = len(result)
+    else:
+        rows = np.nan
+
+    return {'benchmark': name, 'seconds': round(secs, 4), 'peak_mb': round(peak/1024/1024, 2), 'rows': rows, 'rows_per_sec': round(rows/secs, 1) if secs > 0 else np.nan}
+
+
+def raw_callback(func):
+    """
+    The undecorated function of a Dash callback.
+    """
+    return getattr(func, '__wrapped__', func)
+
+
+def function_benchmarks(from_date, to_date):
+    import util
+    from_str = str(from_date.date())
+    to_str = str(to_date.date())
+    dataset_dict = {'features': usage_datasets['Feature'].unique().tolist(), 'mtypes': ['Abstraction'], 'ctypes': ['Recorder'], 'data_codes': ['RAW'], 'data_providers': ['ECan']}
+
+    results = []
+    results.append(measure('lf_site_summ', util.lf_site_summ, server, database, from_str, to_str, use_cache=False))
+    results.append(measure('lf_site_summ (cached)', util.lf_site_summ, server, database, from_str, to_str))
+    results.append(measure('ecan_ts_summ', util.ecan_ts_summ, server, database, **dataset_dict))
+    results.append(measure('app_ts_summ', util.app_ts_summ, server, database, **dataset_dict))
+
+    ts_summ = util.app_ts_summ(server, database, **dataset_dict)
+    results.append(measure('sel_ts_summ', util.sel_ts_summ, ts_summ, start_date=from_date, end_date=to_date, **dataset_dict))
+
+    lf_summ = util.lf_site_summ(server, database, from_str, to_str)
+    usage_summ = util.ecan_ts_summ(server, database, **dataset_dict)
+    results.append(measure('app_allo_usage_summ', util.app_allo_usage_summ, server, database, from_str, to_str, lf_summ, usage_summ))
+
+    return results
+
+
+def callback_benchmarks(from_date, to_date):
+    import app
+    from_str = str(from_date.date())
+    to_str = str(to_date.date())
+
+    summ_key = raw_callback(app.store_summ)(from_str, to_str)
+    summ1 = app.data_store.get(summ_key)
+    site1 = summ1.ExtSiteID.iloc[0]
+
+    results = []
+    results.append(measure('store_summ', raw_callback(app.store_summ), from_str, to_str))
+    results.append(measure('site_geometry', raw_callback(app.site_geometry), summ_key, to_str))
+    results.append(measure('update_sites_options', raw_callback(app.update_sites_options), summ_key))
+    results.append(measure('plot_table', raw_callback(app.plot_table), summ_key, None, {'current_page': 0, 'page_size': app.table_page_size}, [{'column_id': 'Flow or water level', 'direction': 'desc'}], ''))
+    results.append(measure('update_band_options', raw_callback(app.update_band_options), [site1], 'band', from_str, to_str))
+    results.append(measure('display_data', raw_callback(app.display_data), [site1], [1, 2], from_str, to_str, None))
+    results.append(measure('download csv', lambda key: ''.join(app.csv_chunks(app.data_store.get(key))), summ_key))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the low flows dashboard against a synthetic database.')
+    parser.add_argument('--sites', type=int, default=200)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--consents', type=int, default=1000)
+    parser.add_argument('--db', default=None, help='sqlite file for the synthetic database (default: a temporary file)')
+    parser.add_argument('--no-callbacks', action='store_true', help='only benchmark the util functions')
+    parser.add_argument('--output', default=None, help='csv file to write the results to')
+    args = parser.parse_args(argv)
+
+    db_path = args.db
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(), 'hydro.sqlite')
+
+    start1 = time.perf_counter()
+    counts = make_synthetic_db(db_path, args.sites, args.days, args.consents)
+    print('Synthetic database ' + db_path + ' built in ' + str(round(time.perf_counter() - start1, 1)) + ' s')
+    print(pd.Series(counts).to_string())
+
+    dbpool.engine_urls[(server, database)] = 'sqlite:///' + db_path
+
+    import util
+    util.allo_ts = synthetic_allo_ts
+
+    to_date = pd.Timestamp.now().floor('D')
+    from_date = to_date - pd.Timedelta(days=args.days - 1)
+
+    results = function_benchmarks(from_date, to_date)
+    if not args.no_callbacks:
+        results.extend(callback_benchmarks(from_date, to_date))
+
+    results1 = pd.DataFrame(results).set_index('benchmark')
+    results1['sites'] = args.sites
+    results1['days'] = args.days
+    results1['consents'] = args.consents
+
+    print(results1.to_string())
+    if args.output is not None:
+        results1.to_csv(args.output)
+
+    return results1
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Pooled database connections shared by the util functions and the app callbacks. rd_sql takes the same arguments as pdsql.mssql.rd_sql, but reuses the connections of one SQLAlchemy engine per server and database.
+"""
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import event, text, bindparam
+from sqlalchemy.pool import StaticPool
+import metrics
+from singleflight import SingleFlight, normalize
+
+##########################################
+### Parameters
+
+odbc_driver = 'ODBC Driver 17 for SQL Server'
+
+pool_size = 5
+max_overflow = 10
+pool_timeout = 30
+pool_recycle = 3600
+
+## Large IN lists are split into chunks with at most max_in_params values per query (SQL Server allows 2100 parameters)
+max_in_params = 1000
+chunk_workers = 4
+
+## (server, database) to SQLAlchemy url overrides, e.g. {('edwprod01', 'hydro'): 'sqlite:///hydro.sqlite'} for a local stand-in
+engine_urls = {}
+
+_engines = {}
+_engines_lock = threading.Lock()
+_connect_stats = {}
+_stats_lock = threading.Lock()
+_connect_start = threading.local()
+_read_flight = SingleFlight('rd_sql')
+
+##########################################
+### Functions
+
+
+def engine_url(server, database):
+    """
+    The SQLAlchemy url for a server and database.
+    """
+    if (server, database) in engine_urls:
+        return engine_urls[(server, database)]
+    return 'mssql+pyodbc://' + server + '/' + database + '?driver=' + odbc_driver.replace(' ', '+') + '&trusted_connection=yes'
+
+
+def _add_connect_metrics(engine, key):
+    stats = {'connects': 0, 'connect_seconds': 0.0, 'max_connect_seconds': 0.0, 'checkouts': 0}
+    _connect_stats[key] = stats
+
+    @event.listens_for(engine, 'do_connect')
+    def do_connect(dialect, conn_rec, cargs, cparams):
+        _connect_start.time = time.time()
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_con, con_record):
+        secs = time.time() - getattr(_connect_start, 'time', time.time())
+        with _stats_lock:
+            stats['connects'] += 1
+            stats['connect_seconds'] += secs
+            stats['max_connect_seconds'] = max(stats['max_connect_seconds'], secs)
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_con, con_record, con_proxy):
+        with _stats_lock:
+            stats['checkouts'] += 1
+
+
+def get_engine(server, database):
+    """
+    The pooled engine for a server and database. Connections are checked with a ping before they are handed out.
+    """
+    key = (server, database)
+    with _engines_lock:
+        if key not in _engines:
+            url = engine_url(server, database)
+            if url.startswith('sqlite'):
+                kwargs = {'connect_args': {'check_same_thread': False}}
+                if url in ('sqlite://', 'sqlite:///:memory:'):
+                    kwargs['poolclass'] = StaticPool
+                engine = sqlalchemy.create_engine(url, pool_pre_ping=True, **kwargs)
+            else:
+                engine = sqlalchemy.create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout, pool_recycle=pool_recycle, pool_pre_ping=True)
+            _add_connect_metrics(engine, key)
+            _engines[key] = engine
+        return _engines[key]
+
+
+def dispose_engines():
+    """
+    Close all pooled connections.
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def pool_stats():
+    """
+    DataFrame of the connection pool metrics per server and database.
+    """
+    rows = []
+    with _stats_lock:
+        items = [(key, dict(stats)) for key, stats in _connect_stats.items()]
+    for key, row in items:
+        row['server'], row['database'] = key
+        if key in _engines:
+            row['pool_status'] = _engines[key].pool.status()
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _pool_gauges():
+    gauges = []
+    for _, row in pool_stats().iterrows():
+        name = row['server'] + '/' + row['database']
+        gauges.extend([('db_connects', name, row['connects']), ('db_connect_seconds', name, row['connect_seconds']), ('db_max_connect_seconds', name, row['max_connect_seconds']), ('db_checkouts', name, row['checkouts'])])
+    return gauges
+
+
+metrics.add_collector(_pool_gauges)
+
+
+def sql_select(table, col_names=None, where_in=None, where_op='AND', from_date=None, to_date=None, date_col=None):
+    """
+    Build a parameterised select statement. Returns a tuple of the SQLAlchemy text clause and the dict of parameters.
+    """
+    if col_names is None:
+        cols = '*'
+    else:
+        cols = ', '.join(col_names)
+    stmt = 'SELECT ' + cols + ' FROM ' + table
+
+    where_list = []
+    params = {}
+    binds = []
+    if where_in:
+        in_list = []
+        for i, (col, values) in enumerate(where_in.items()):
+            name = 'in' + str(i)
+            in_list.append(col + ' IN :' + name)
+            params[name] = list(values)
+            binds.append(bindparam(name, expanding=True))
+        where_list.append('(' + (' ' + where_op + ' ').join(in_list) + ')')
+    if from_date is not None:
+        where_list.append(date_col + ' >= :from_date')
+        params['from_date'] = str(from_date)
+    if to_date is not None:
+        where_list.append(date_col + ' <= :to_date')
+        params['to_date'] = str(to_date)
+
+    if where_list:
+        stmt = stmt + ' WHERE ' + ' AND '.join(where_list)
+
+    return text(stmt).bindparams(*binds), params
+
+
+def chunk_where_in(where_in, max_params=max_in_params):
+    """
+    Split a where_in dict into a list of where_in dicts with at most max_params values in total each. The largest list is split first and duplicate values are removed. Only valid for where_op='AND', where the chunks select disjoint rows.
+    """
+    where_in = OrderedDict((col, list(OrderedDict.fromkeys(values))) for col, values in where_in.items())
+    total = sum(len(v) for v in where_in.values())
+    if total <= max_params:
+        return [where_in]
+
+    col = max(where_in, key=lambda c: len(where_in[c]))
+    values = where_in[col]
+    others = total - len(values)
+    size = max(max_params - others, max_params//2, 1)
+
+    chunks = []
+    for i in range(0, len(values), size):
+        sub = OrderedDict(where_in)
+        sub[col] = values[i:i + size]
+        chunks.extend(chunk_where_in(sub, max_params))
+
+    return chunks
+
+
+def _read_stmt(server, database, stmt, params):
+    with get_engine(server, database).connect() as con:
+        return pd.read_sql(stmt, con, params=params)
+
+
+def rd_sql(server, database, table=None, col_names=None, where_in=None, where_op='AND', from_date=None, to_date=None, date_col=None, rename_cols=None, stmt=None):
+    """
+    Read a table or a sql statement into a DataFrame using a pooled connection. where_in lists with more than max_in_params values in total are split into chunks that are read concurrently and concatenated. Identical concurrent reads share one query and each caller gets its own copy of the result.
+    """
+    key = (server, database, table, None if col_names is None else tuple(col_names), normalize(where_in), where_op.upper(), from_date, to_date, date_col, None if rename_cols is None else tuple(rename_cols), stmt)
+    return _read_flight.do(key, lambda: _rd_sql(server, database, table, col_names, where_in, where_op, from_date, to_date, date_col, rename_cols, stmt), copy=pd.DataFrame.copy)
+
+
+def _rd_sql(server, database, table, col_names, where_in, where_op, from_date, to_date, date_col, rename_cols, stmt):
+    with metrics.timer('query', table if stmt is None else 'stmt') as t:
+        if stmt is not None:
+            df = _read_stmt(server, database, text(stmt), {})
+        elif where_in and where_op.upper() == 'AND' and sum(len(v) for v in where_in.values()) > max_in_params:
+            queries = [sql_select(table, col_names, w, where_op, from_date, to_date, date_col) for w in chunk_where_in(where_in, max_in_params)]
+            with ThreadPoolExecutor(min(chunk_workers, len(queries))) as executor:
+                df_list = list(executor.map(lambda q: _read_stmt(server, database, q[0], q[1]), queries))
+            df = pd.concat(df_list, ignore_index=True)
+        else:
+            stmt, params = sql_select(table, col_names, where_in, where_op, from_date, to_date, date_col)
+            df = _read_stmt(server, database, stmt, params)
+        t.rows = len(df)
+        t.nbytes = int(df.memory_usage(index=False).sum())
+
+    if rename_cols is not None:
+        df.columns = rename_cols
+
+    return df
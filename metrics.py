@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Latency, row count and payload size metrics for the Dash callbacks, database queries, allo_ts and Hilltop requests. The metrics are served in the Prometheus text format.
+"""
+import os
+import time
+import json
+import cProfile
+import threading
+from functools import wraps
+
+##########################################
+### Parameters
+
+prefix = 'lowflows'
+
+time_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+byte_buckets = (1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+## Measure the json size of the callback outputs
+measure_payload = True
+
+## Set to a number of seconds to save a cProfile of every callback slower than that into profile_dir
+profile_slow = None
+profile_dir = 'profiles'
+
+_histograms = {}
+_counters = {}
+_collectors = []
+_lock = threading.Lock()
+
+##########################################
+### Classes
+
+
+class Histogram(object):
+    """
+    Cumulative bucket counts, sum and count of observed values.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class timer(object):
+    """
+    Context manager that records the run time of a block as <kind>_seconds{name=...}. Set the rows or nbytes attributes inside the block to also record them.
+    """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.rows = None
+        self.nbytes = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.kind, self.name, time.time() - self.start, self.rows, self.nbytes, error=exc_type is not None)
+        return False
+
+
+##########################################
+### Functions
+
+
+def observe(metric, name, value, buckets=time_buckets):
+    with _lock:
+        key = (metric, name)
+        if key not in _histograms:
+            _histograms[key] = Histogram(buckets)
+        _histograms[key].observe(value)
+
+
+def inc(metric, name, value=1):
+    with _lock:
+        key = (metric, name)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def record(kind, name, seconds, rows=None, nbytes=None, error=False):
+    """
+    Record one call of a kind (callback, query, allo_ts, hilltop) and name.
+    """
+    observe(kind + '_seconds', name, seconds)
+    if rows is not None:
+        inc(kind + '_rows_total', name, rows)
+    if nbytes is not None:
+        observe(kind + '_payload_bytes', name, nbytes, byte_buckets)
+    if error:
+        inc(kind + '_errors_total', name)
+
+
+def add_collector(func):
+    """
+    Add a function returning a list of (metric, name, value) gauges to include in the output.
+    """
+    _collectors.append(func)
+
+
+def _profile_call(name, func, args, kwargs):
+    prof = cProfile.Profile()
+    start1 = time.time()
+    result = prof.runcall(func, *args, **kwargs)
+    if (time.time() - start1) > profile_slow:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        prof.dump_stats(os.path.join(profile_dir, name + '-' + time.strftime('%Y%m%d-%H%M%S') + '.prof'))
+    return result
+
+
+def timed_callback(func):
+    """
+    Wrap a Dash callback function to record its run time and output size.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timer('callback', name) as t:
+            if profile_slow is not None:
+                output = _profile_call(name, func, args, kwargs)
+            else:
+                output = func(*args, **kwargs)
+            if measure_payload:
+                from plotly.utils import PlotlyJSONEncoder
+                t.nbytes = len(json.dumps(output, cls=PlotlyJSONEncoder))
+        return output
+
+    return wrapper
+
+
+def instrument_callbacks(app):
+    """
+    Make app.callback time every callback registered after this call.
+    """
+    callback1 = app.callback
+
+    def callback(*args, **kwargs):
+        decorator = callback1(*args, **kwargs)
+
+        def wrap(func):
+            return decorator(timed_callback(func))
+
+        return wrap
+
+    app.callback = callback
+
+
+def _labels(name):
+    return 'name="' + str(name).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def prometheus_text():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        hists = sorted(((k, h.buckets, list(h.counts), h.sum, h.count) for k, h in _histograms.items()), key=lambda x: x[0])
+        counters = sorted(_counters.items())
+
+    lines = []
+    last_metric = None
+    for (metric, name), buckets, counts, sum1, count1 in hists:
+        full = prefix + '_' + metric
+        if metric != last_metric:
+            lines.append('# TYPE ' + full + ' histogram')
+            last_metric = metric
+        for b, c in zip(buckets, counts):
+            lines.append(full + '_bucket{' + _labels(name) + ',le="' + str(b) + '"} ' + str(c))
+        lines.append(full + '_bucket{' + _labels(name) + ',le="+Inf"} ' + str(count1))
+        lines.append(full + '_sum{' + _labels(name) + '} ' + repr(float(sum1)))
+        lines.append(full + '_count{' + _labels(name) + '} ' + str(count1))
+
+    for (metric, name), value in counters:
+        full = prefix + '_' + metric
+        if metric != last_metric:
+            lines.append('# TYPE ' + full + ' counter')
+            last_metric = metric
+        lines.append(full + '{' + _labels(name) + '} ' + str(value))
+
+    for collector in _collectors:
+        for metric, name, value in sorted(collector()):
+            full = prefix + '_' + metric
+            if metric != last_metric:
+                lines.append('# TYPE ' + full + ' gauge')
+                last_metric = metric
+            lines.append(full + '{' + _labels(name) + '} ' + str(value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def register_route(flask_server, path='/metrics'):
+    """
+    Serve the metrics on a route of the Flask server.
+    """
+    from flask import Response
+
+    def metrics_view():
+        return Response(prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+    flask_server.add_url_rule(path, 'metrics', metrics_view)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Optional local Parquet mirror of the daily usage data in TSDataNumericDaily, partitioned by DatasetTypeID and month. Requires pyarrow.
+"""
+import os
+import uuid
+import threading
+import pandas as pd
+from dbpool import rd_sql
+from util import ts_table, ts_summ_table
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+##########################################
+### Parameters
+
+state_file = '_sync_state.csv'
+state_cols = ['DatasetTypeID', 'ExtSiteID', 'ToDate']
+
+##########################################
+### Classes
+
+
+class UsageMirror(object):
+    """
+    Parquet mirror of TSDataNumericDaily in path, laid out as DatasetTypeID=<id>/month=<YYYY-MM>/<part>.parquet. sync copies the new rows from SQL Server and read answers usage queries from the local files.
+    """
+    def __init__(self, path):
+        if pa is None:
+            raise ImportError('pyarrow is required for the usage mirror')
+        self.path = path
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def synced(self):
+        """
+        DataFrame of the last synced ToDate per DatasetTypeID and ExtSiteID.
+        """
+        state_path = os.path.join(self.path, state_file)
+        if os.path.isfile(state_path):
+            state = pd.read_csv(state_path, parse_dates=['ToDate'], dtype={'ExtSiteID': str})
+            ## State files written before the IDs were read as strings can hold duplicate sites
+            return state.drop_duplicates(['DatasetTypeID', 'ExtSiteID'], keep='last')
+        return pd.DataFrame({'DatasetTypeID': pd.Series([], dtype='int64'), 'ExtSiteID': pd.Series([], dtype=object), 'ToDate': pd.Series([], dtype='datetime64[ns]')})
+
+    def _write(self, ts1):
+        ts1 = ts1.copy()
+        ts1['month'] = ts1['DateTime'].dt.strftime('%Y-%m')
+        for (dataset, month), part in ts1.groupby(['DatasetTypeID', 'month']):
+            part_dir = os.path.join(self.path, 'DatasetTypeID=' + str(dataset), 'month=' + month)
+            if not os.path.isdir(part_dir):
+                os.makedirs(part_dir)
+            name = uuid.uuid4().hex + '.parquet'
+            tmp_path = os.path.join(part_dir, '_' + name)
+            table = pa.Table.from_pandas(part[['ExtSiteID', 'DateTime', 'Value']], preserve_index=False)
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, os.path.join(part_dir, name))
+
+    def sync(self, server, database, dataset_ids):
+        """
+        Copy the rows that are not mirrored yet. The ToDate per site in TSDataNumericDailySumm is compared with the last synced ToDate and only the newer rows are read. Returns the number of rows added.
+        """
+        with self._lock:
+            summ = rd_sql(server, database, ts_summ_table, ['ExtSiteID', 'DatasetTypeID', 'FromDate', 'ToDate'], where_in={'DatasetTypeID': dataset_ids})
+            summ['FromDate'] = pd.to_datetime(summ['FromDate'])
+            summ['ToDate'] = pd.to_datetime(summ['ToDate'])
+
+            state = self.synced()
+            summ1 = pd.merge(summ, state, on=['DatasetTypeID', 'ExtSiteID'], how='left', suffixes=('', '_synced'))
+            new1 = summ1[summ1['ToDate_synced'].isnull() | (summ1['ToDate'] > summ1['ToDate_synced'])].copy()
+            if new1.empty:
+                return 0
+
+            new1['start'] = (new1['ToDate_synced'] + pd.Timedelta(days=1)).fillna(new1['FromDate'])
+
+            ts_list = []
+            for dataset, sites in new1.groupby('DatasetTypeID'):
+                ts0 = rd_sql(server, database, ts_table, ['ExtSiteID', 'DateTime', 'Value'], where_in={'DatasetTypeID': [dataset], 'ExtSiteID': sites.ExtSiteID.tolist()}, from_date=str(sites['start'].min().date()), to_date=str(sites['ToDate'].max().date()), date_col='DateTime')
+                ts0['DateTime'] = pd.to_datetime(ts0['DateTime'])
+                start1 = ts0['ExtSiteID'].map(sites.set_index('ExtSiteID')['start'])
+                ts0 = ts0[ts0['DateTime'] >= start1]
+                ts0['DatasetTypeID'] = dataset
+                ts_list.append(ts0)
+            ts1 = pd.concat(ts_list, ignore_index=True)
+
+            if not ts1.empty:
+                self._write(ts1)
+
+            ## Update the sync state
+            state1 = pd.concat([state, new1[state_cols]], sort=False).drop_duplicates(['DatasetTypeID', 'ExtSiteID'], keep='last')
+            state_path = os.path.join(self.path, state_file)
+            state1[state_cols].to_csv(state_path + '.tmp', index=False)
+            os.replace(state_path + '.tmp', state_path)
+
+            return len(ts1)
+
+    def read(self, dataset_ids, sites, from_date, to_date):
+        """
+        Read the mirrored ExtSiteID, DateTime and Value rows with the same selection as the usage read from TSDataNumericDaily. Only the partitions of the datasets and months in the range are opened and the files are memory mapped.
+        """
+        from_date = pd.Timestamp(from_date)
+        to_date = pd.Timestamp(to_date)
+        filters = [('DatasetTypeID', 'in', set(int(d) for d in dataset_ids)), ('month', '>=', from_date.strftime('%Y-%m')), ('month', '<=', to_date.strftime('%Y-%m'))]
+
+        try:
+            table = pq.read_table(self.path, columns=['ExtSiteID', 'DateTime', 'Value'], filters=filters, memory_map=True)
+        except (ValueError, OSError):
+            return pd.DataFrame(columns=['ExtSiteID', 'DateTime', 'Value'])
+        ts1 = table.to_pandas()
+
+        ts1 = ts1[ts1['ExtSiteID'].isin(sites) & (ts1['DateTime'] >= from_date) & (ts1['DateTime'] <= to_date)]
+
+        return ts1[['ExtSiteID', 'DateTime', 'Value']].reset_index(drop=True)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight calls. Concurrent calls with the same key wait on one running computation and share its result instead of repeating it.
+"""
+import time
+import threading
+import metrics
+
+##########################################
+### Classes
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Runs one func per key at a time. Callers arriving while the key is in flight wait for it and get its result or its exception. Pass copy to give every caller its own copy of a mutable result. Calls and coalesced waits are counted as singleflight_calls_total and singleflight_coalesced_total under name.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, copy=None):
+        """
+        Return func(), or the result of the identical call already running for key.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if not leader:
+            start1 = time.time()
+            call.done.wait()
+            metrics.inc('singleflight_coalesced_total', self.name)
+            metrics.observe('singleflight_wait_seconds', self.name, time.time() - start1)
+            if call.error is not None:
+                raise call.error
+            if copy is not None:
+                return copy(call.result)
+            return call.result
+
+        metrics.inc('singleflight_calls_total', self.name)
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            ## No caller can join once the call is removed, so waiters is final here
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            call.done.set()
+
+        if waiters and copy is not None:
+            return copy(call.result)
+        return call.result
+
+
+##########################################
+### Functions
+
+
+def normalize(value):
+    """
+    Hashable key of nested call arguments. Lists and sets are sorted by their repr so the same values in another order give the same key.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), normalize(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [normalize(v) for v in value]
+        if not isinstance(value, tuple):
+            items = sorted(set(items), key=repr)
+        return tuple(items)
+    if hasattr(value, 'tolist'):
+        return normalize(value.tolist())
+    return value
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Background refreshed snapshot of the default dashboard data. Page loads are served from the latest snapshot in memory instead of querying the database on every request.
+"""
+import os
+import uuid
+import pickle
+import logging
+import threading
+import pandas as pd
+import util
+from util import lf_site_summ, ecan_ts_summ, app_allo_usage_summ
+from store import make_key
+
+logger = logging.getLogger(__name__)
+
+##########################################
+### Classes
+
+
+class Snapshot(object):
+    """
+    The default dataset for the dashboard at a point in time.
+    """
+    def __init__(self, from_date, to_date, lf_summ, usage_ts_summ, allo_usage, built=None):
+        self.from_date = from_date
+        self.to_date = to_date
+        self.lf_summ = lf_summ
+        self.usage_ts_summ = usage_ts_summ
+        self.allo_usage = allo_usage
+        if built is None:
+            built = pd.Timestamp.now()
+        self.built = built
+
+    def age(self):
+        """
+        The age of the snapshot as a pandas Timedelta.
+        """
+        return pd.Timestamp.now() - self.built
+
+
+class SnapshotScheduler(object):
+    """
+    Rebuilds a Snapshot with build_func every interval seconds in a daemon thread. The previous snapshot is served while a rebuild is running or if a rebuild fails. With persist_path, every new snapshot is saved to disk and the last one saved can be loaded at startup as the last known good data.
+    """
+    def __init__(self, build_func, interval=600, persist_path=None):
+        self.build_func = build_func
+        self.interval = interval
+        self.persist_path = persist_path
+        self.last_error = None
+        self._snapshot = None
+        self._building = False
+        self._build_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def building(self):
+        return self._building
+
+    def start(self):
+        """
+        Start the refresh thread if it is not running.
+        """
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='snapshot-refresh', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Snapshot rebuild failed, serving the previous snapshot')
+            self._stop.wait(self.interval)
+
+    def refresh(self):
+        """
+        Build a new snapshot and swap it in. Concurrent calls wait for the build already running.
+        """
+        with self._build_lock:
+            self._building = True
+            try:
+                new1 = self.build_func()
+                self.last_error = None
+            except Exception as err:
+                self.last_error = err
+                raise
+            finally:
+                self._building = False
+            self._snapshot = new1
+            if self.persist_path is not None:
+                try:
+                    self.save(new1)
+                except (OSError, pickle.PicklingError):
+                    pass
+        return new1
+
+    def save(self, snap):
+        """
+        Write a snapshot to persist_path, replacing the previous file in one step.
+        """
+        tmp_path = self.persist_path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snap, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.persist_path)
+
+    def load(self):
+        """
+        Load the snapshot saved at persist_path if there is no snapshot yet, so it is served until the first rebuild finishes. Returns the loaded snapshot, or None if there is none or it cannot be read (e.g. written by other pandas or numpy versions).
+        """
+        if self.persist_path is None or not os.path.isfile(self.persist_path):
+            return None
+        try:
+            with open(self.persist_path, 'rb') as f:
+                snap = pickle.load(f)
+        except Exception:
+            logger.exception('Could not load the saved snapshot ' + self.persist_path)
+            return None
+        with self._build_lock:
+            if self._snapshot is None:
+                self._snapshot = snap
+        return snap
+
+    def get(self):
+        """
+        Return the latest snapshot. Only the very first call blocks, until the first snapshot has been built.
+        """
+        snap = self._snapshot
+        if snap is None:
+            with self._build_lock:
+                snap = self._snapshot
+            if snap is None:
+                snap = self.refresh()
+        return snap
+
+
+##########################################
+### Functions
+
+
+def build_snapshot(server, database, dataset_dict, weeks=2, shared=None, max_age=None):
+    """
+    Build the default dataset for the last number of weeks. With a store.SharedStore the frames are built by one worker process and read by the others, and are rebuilt once older than max_age seconds.
+    """
+    to_date = pd.Timestamp.now().floor('D')
+    from_date = to_date - pd.DateOffset(weeks=weeks)
+    from_str = str(from_date.date())
+    to_str = str(to_date.date())
+
+    def build(key, func):
+        if shared is None:
+            return func()
+        return shared.get_or_build(key, func, max_age)
+
+    def build_usage_summ():
+        usage_ts_summ = ecan_ts_summ(server, database, **dataset_dict)
+        if util.usage_mirror is not None:
+            util.usage_mirror.sync(server, database, usage_ts_summ.DatasetTypeID.unique().tolist())
+        return usage_ts_summ
+
+    lf_summ = build(make_key('lf_site_summ', from_str, to_str), lambda: lf_site_summ(server, database, from_str, to_str))
+    usage_ts_summ = build(make_key('ecan_ts_summ'), build_usage_summ)
+    allo_usage = build(make_key('app_allo_usage_summ', from_str, to_str), lambda: app_allo_usage_summ(server, database, from_str, to_str, lf_summ, usage_ts_summ))
+
+    return Snapshot(from_date, to_date, lf_summ, usage_ts_summ, allo_usage)
+
+
+def snapshot_age_text(snap, building=False, error=None):
+    """
+    Short text describing the age of a snapshot for display, with the type of the last failed rebuild error if there is one. The full error is only logged, as it can hold connection details.
+    """
+    mins = int(snap.age().total_seconds() // 60)
+    text1 = 'Data as of ' + snap.built.strftime('%d/%m/%Y %H:%M') + ' (' + str(mins) + ' min old)'
+    if building:
+        text1 = text1 + ', refreshing...'
+    if error is not None:
+        text1 = text1 + '. Last refresh failed (' + type(error).__name__ + ')'
+    return text1
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side store of query results. The browser only holds the small key and the callbacks get the already parsed DataFrame.
+"""
+import os
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import pandas as pd
+from singleflight import SingleFlight
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+##########################################
+### Parameters
+
+key_sep = '|'
+
+## Shared store locks not touched for this many seconds are treated as abandoned. Builders touch their lock every lock_timeout / 4 seconds
+lock_timeout = 600
+lock_poll = 0.2
+
+## Shared store files not rewritten for this many seconds are deleted, checked at most every prune_interval seconds
+shared_keep_age = 86400
+prune_interval = 600
+
+##########################################
+### Functions
+
+
+def make_key(name, *params):
+    """
+    Make a store key from a loader name and the query parameters.
+    """
+    return key_sep.join([name] + [str(p) for p in params])
+
+
+def split_key(key):
+    """
+    Split a store key back into the loader name and the query parameters.
+    """
+    parts = key.split(key_sep)
+    return parts[0], parts[1:]
+
+
+##########################################
+### Classes
+
+
+class SharedStore(object):
+    """
+    On-disk store of DataFrames shared by all worker processes on a node. Frames are written as Parquet (pickle if pyarrow is missing or the frame cannot be converted) with an atomic rename, and read memory mapped. get_or_build lets a single process rebuild a key while the others keep reading the previous file or wait for the first one. Files older than keep_age are pruned.
+    """
+    def __init__(self, path, keep_age=shared_keep_age):
+        self.path = path
+        self.keep_age = keep_age
+        self._last_prune = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def prune(self):
+        """
+        Delete the frames older than keep_age and temporary files left by crashed writers. Returns the number of files deleted.
+        """
+        self._last_prune = time.time()
+        n = 0
+        for name in os.listdir(self.path):
+            if name.endswith(('.parquet', '.pkl')):
+                max_age = self.keep_age
+            elif name.endswith('.tmp'):
+                max_age = lock_timeout
+            else:
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if (time.time() - os.path.getmtime(path)) > max_age:
+                    os.remove(path)
+                    n += 1
+            except OSError:
+                pass
+        return n
+
+    def _base(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _find(self, key):
+        base = self._base(key)
+        for ext in ('.parquet', '.pkl'):
+            if os.path.isfile(base + ext):
+                return base + ext
+        return None
+
+    def age(self, key):
+        """
+        Seconds since the frame of key was written, or None if it is not stored.
+        """
+        path = self._find(key)
+        if path is None:
+            return None
+        return time.time() - os.path.getmtime(path)
+
+    def get(self, key):
+        path = self._find(key)
+        if path is None:
+            return None
+        try:
+            if path.endswith('.parquet'):
+                return pq.read_table(path, memory_map=True).to_pandas()
+            return pd.read_pickle(path)
+        except (OSError, EOFError):
+            return None
+
+    def put(self, key, df):
+        base = self._base(key)
+        tmp_base = base + '.' + uuid.uuid4().hex + '.tmp'
+        ext = '.pkl'
+        if pa is not None:
+            try:
+                pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_base)
+                ext = '.parquet'
+            except (pa.ArrowException, TypeError, ValueError):
+                if os.path.isfile(tmp_base):
+                    os.remove(tmp_base)
+        if ext == '.pkl':
+            df.to_pickle(tmp_base)
+        os.replace(tmp_base, base + ext)
+        other = base + ('.pkl' if ext == '.parquet' else '.parquet')
+        if os.path.isfile(other):
+            os.remove(other)
+
+        if (time.time() - self._last_prune) > prune_interval:
+            self.prune()
+        return key
+
+    def _acquire(self, key):
+        """
+        Create the lock file of key holding a unique token. Returns the lock path and token, or None if another live process holds the lock.
+        """
+        lock_path = self._base(key) + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if (time.time() - os.path.getmtime(lock_path)) > lock_timeout:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return None
+        token = uuid.uuid4().hex
+        os.write(fd, token.encode('ascii'))
+        os.close(fd)
+        return lock_path, token
+
+    def _holds(self, lock_path, token):
+        try:
+            with open(lock_path) as f:
+                return f.read() == token
+        except OSError:
+            return False
+
+    def _heartbeat(self, lock_path, token, stop):
+        """
+        Touch the lock file while a build runs so other processes do not take it for abandoned.
+        """
+        while not stop.wait(lock_timeout / 4.0):
+            if not self._holds(lock_path, token):
+                return
+            try:
+                os.utime(lock_path, None)
+            except OSError:
+                return
+
+    def _release(self, lock_path, token):
+        if self._holds(lock_path, token):
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def get_or_build(self, key, build_func, max_age=None):
+        """
+        Return the stored frame of key, building it with build_func if it is missing or older than max_age seconds. Only the process holding the key's lock file builds; the others return the stale frame if there is one, or wait for the build to finish.
+        """
+        while True:
+            age1 = self.age(key)
+            if age1 is not None and (max_age is None or age1 <= max_age):
+                df = self.get(key)
+                if df is not None:
+                    return df
+
+            lock = self._acquire(key)
+            if lock is not None:
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=lock + (stop,), daemon=True)
+                heartbeat.start()
+                try:
+                    df = build_func()
+                    self.put(key, df)
+                    return df
+                finally:
+                    stop.set()
+                    heartbeat.join()
+                    self._release(*lock)
+
+            if age1 is not None:
+                df = self.get(key)
+                if df is not None:
+                    return df
+
+            time.sleep(lock_poll)
+
+
+class DataStore(object):
+    """
+    In-process LRU store of DataFrames. Evicted frames are spilled to spill_dir if it is set. Loaders registered by name are used to rebuild frames that are in neither, once per key however many callbacks ask for it at the same time. Frames older than the max age of their loader are loaded again. With a SharedStore, loader results are built once and shared between worker processes.
+    """
+    def __init__(self, max_items=32, spill_dir=None, shared=None):
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self.shared = shared
+        self._data = OrderedDict()
+        self._loaders = {}
+        self._max_ages = {}
+        self._lock = threading.RLock()
+        self._flight = SingleFlight('store')
+        if spill_dir is not None and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def register(self, name, loader, max_age=None):
+        """
+        Register a loader function that takes the key parameters as arguments and returns a DataFrame. max_age is the number of seconds a loaded frame is kept, or a function of the key parameters returning it; None keeps frames until they are evicted.
+        """
+        self._loaders[name] = loader
+        self._max_ages[name] = max_age
+
+    def _max_age(self, key):
+        name, params = split_key(key)
+        max_age = self._max_ages.get(name)
+        if callable(max_age):
+            max_age = max_age(*params)
+        return max_age
+
+    def _fresh(self, key, stored):
+        max_age = self._max_age(key)
+        return max_age is None or (time.time() - stored) <= max_age
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    def _spilled(self, key):
+        """
+        The spill file of key if there is a fresh one.
+        """
+        if self.spill_dir is None:
+            return None
+        path = self._spill_path(key)
+        if os.path.isfile(path) and self._fresh(key, os.path.getmtime(path)):
+            return path
+        return None
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._data and self._fresh(key, self._data[key][1]):
+                return True
+        return self._spilled(key) is not None
+
+    def put(self, key, df, stored=None):
+        """
+        Add a DataFrame to the store and return the key.
+        """
+        if stored is None:
+            stored = time.time()
+        with self._lock:
+            self._data[key] = (df, stored)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                old_key, (old_df, old_stored) = self._data.popitem(last=False)
+                if self.spill_dir is not None:
+                    path = self._spill_path(old_key)
+                    old_df.to_pickle(path)
+                    os.utime(path, (old_stored, old_stored))
+        return key
+
+    def get(self, key):
+        """
+        Get a DataFrame from memory, the spill directory or its loader, in that order. Returns None if the key cannot be resolved.
+        """
+        with self._lock:
+            if key in self._data and self._fresh(key, self._data[key][1]):
+                self._data.move_to_end(key)
+                return self._data[key][0]
+
+        path = self._spilled(key)
+        if path is not None:
+            df = pd.read_pickle(path)
+            self.put(key, df, os.path.getmtime(path))
+            return df
+
+        name, params = split_key(key)
+        if name in self._loaders:
+            return self._flight.do(key, lambda: self._load(key, name, params))
+
+        return None
+
+    def _load(self, key, name, params):
+        if self.shared is not None:
+            df = self.shared.get_or_build(key, lambda: self._loaders[name](*params), self._max_age(key))
+        else:
+            df = self._loaders[name](*params)
+        self.put(key, df)
+        return df
+
+    def get_or_load(self, name, *params):
+        """
+        Return the key for the query parameters, running the loader if the result is not already stored or is too old.
+        """
+        key = make_key(name, *params)
+        if key not in self:
+            self.get(key)
+        return key
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the concurrent Hilltop requests against a local HTTP stand-in serving canned Hilltop XML, with one slow and one failing site.
+"""
+import time
+import threading
+import xml.etree.ElementTree as ET
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen
+from concurrent.futures import TimeoutError
+import pandas as pd
+import pytest
+import util
+
+##########################################
+### Parameters
+
+slow_site = 'SLOW'
+bad_site = 'BAD'
+slow_delay = 3
+
+data_xml = """<?xml version="1.0" standalone="yes"?>
+<Hilltop>
+<Agency>Environment Canterbury</Agency>
+<Measurement SiteName="{site}">
+<DataSource Name="Flow" NumItems="1">
+<TSType>StdSeries</TSType>
+<DataType>SimpleTimeSeries</DataType>
+<Interpolation>Instant</Interpolation>
+<ItemInfo ItemNumber="1">
+<ItemName>Flow</ItemName>
+<Units>m3/s</Units>
+</ItemInfo>
+</DataSource>
+<Data DateFormat="Calendar" NumItems="1">
+<E><T>2019-01-01T00:00:00</T><I1>1.5</I1></E>
+<E><T>2019-01-02T00:00:00</T><I1>2.5</I1></E>
+</Data>
+</Measurement>
+</Hilltop>
+"""
+
+error_xml = """<?xml version="1.0" standalone="yes"?>
+<Hilltop>
+<Error>No data for site {site}</Error>
+</Hilltop>
+"""
+
+##########################################
+### Fixtures and functions
+
+
+class HilltopHandler(BaseHTTPRequestHandler):
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            site = parse_qs(urlparse(self.path).query)['Site'][0]
+            if site.startswith(slow_site):
+                time.sleep(slow_delay)
+            body = (error_xml if site == bad_site else data_xml).format(site=site).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def hilltop_url():
+    HilltopHandler.active = 0
+    HilltopHandler.max_active = 0
+    server1 = ThreadingHTTPServer(('127.0.0.1', 0), HilltopHandler)
+    server1.daemon_threads = True
+    thread1 = threading.Thread(target=server1.serve_forever, daemon=True)
+    thread1.start()
+    yield 'http://127.0.0.1:' + str(server1.server_address[1])
+    server1.shutdown()
+    server1.server_close()
+
+
+def get_data(base_url, hts, site, mtype, from_date, to_date, dtl_method=None):
+    """
+    Minimal GetData request and parser of the stand-in XML, returning the frame layout of hilltoppy's web_service.get_data.
+    """
+    url = base_url + '/' + hts + '?Service=Hilltop&Request=GetData&Site=' + site + '&Measurement=' + mtype + '&From=' + from_date + '&To=' + to_date
+    with urlopen(url) as resp:
+        tree1 = ET.fromstring(resp.read())
+    if tree1.find('Error') is not None:
+        raise ValueError(tree1.find('Error').text)
+    rows = [(site, mtype, pd.Timestamp(e.find('T').text), float(e.find('I1').text)) for e in tree1.find('Measurement').find('Data').findall('E')]
+    return pd.DataFrame(rows, columns=['Site', 'Measurement', 'DateTime', 'Value']).set_index(['Site', 'Measurement', 'DateTime'])
+
+
+def use_stand_in(monkeypatch, url):
+    monkeypatch.setattr(util, '_hilltop_get', lambda site, mtype, from_date, to_date, dtl_method=None: get_data(url, util.hts, site, mtype, from_date, to_date, dtl_method))
+
+
+def test_hilltop_partial_results(hilltop_url, monkeypatch):
+    use_stand_in(monkeypatch, hilltop_url)
+    sites = ['A', slow_site, 'B', bad_site, 'C']
+
+    start1 = time.time()
+    ts_list, failed = util.hilltop_ts_data(sites, 'Flow', '2019-01-01', '2019-01-02', max_workers=2, timeout=1)
+    elapsed = time.time() - start1
+
+    ## The slow site is given up on without waiting for it
+    assert elapsed < slow_delay
+    assert [t.index.get_level_values('Site')[0] for t in ts_list] == ['A', 'B', 'C']
+    assert all(t['Value'].tolist() == [1.5, 2.5] for t in ts_list)
+    assert sorted(failed) == [bad_site, slow_site]
+    assert isinstance(failed[slow_site], TimeoutError)
+    assert isinstance(failed[bad_site], ValueError)
+    assert HilltopHandler.max_active <= 2
+
+
+def test_hilltop_slow_sites_fill_all_workers(hilltop_url, monkeypatch):
+    use_stand_in(monkeypatch, hilltop_url)
+    sites = [slow_site + '1', slow_site + '2', 'A', 'B']
+
+    start1 = time.time()
+    ts_list, failed = util.hilltop_ts_data(sites, 'Flow', '2019-01-01', '2019-01-02', max_workers=2, timeout=1)
+    elapsed = time.time() - start1
+
+    ## The queued sites start once the slow requests time out, not when they finish
+    assert elapsed < 2
+    assert [t.index.get_level_values('Site')[0] for t in ts_list] == ['A', 'B']
+    assert sorted(failed) == [slow_site + '1', slow_site + '2']
+    assert all(isinstance(e, TimeoutError) for e in failed.values())
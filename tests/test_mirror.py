@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the usage mirror sync against a sqlite stand-in of the hydro database.
+"""
+import os
+import sqlite3
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import dbpool
+from mirror import UsageMirror, state_file
+
+##########################################
+### Functions
+
+
+def write_usage(db_path, to_date):
+    dates = pd.date_range('2019-01-01', to_date)
+    ts = pd.DataFrame([(5, s, str(d.date()), 1.0) for s in ['123', '456'] for d in dates], columns=['DatasetTypeID', 'ExtSiteID', 'DateTime', 'Value'])
+    summ = pd.DataFrame({'ExtSiteID': ['123', '456'], 'DatasetTypeID': [5, 5], 'FromDate': '2019-01-01', 'ToDate': to_date})
+    con = sqlite3.connect(db_path)
+    try:
+        ts.to_sql('TSDataNumericDaily', con, index=False, if_exists='replace')
+        summ.to_sql('TSDataNumericDailySumm', con, index=False, if_exists='replace')
+    finally:
+        con.close()
+
+
+def test_sync_twice_with_numeric_site_ids(tmp_path):
+    db_path = str(tmp_path / 'hydro.sqlite')
+    dbpool.engine_urls[('mirror_test', 'hydro')] = 'sqlite:///' + db_path
+    mirror1 = UsageMirror(str(tmp_path / 'mirror'))
+
+    write_usage(db_path, '2019-01-05')
+    assert mirror1.sync('mirror_test', 'hydro', [5]) == 10
+
+    ## Nothing new, then only the new days
+    assert mirror1.sync('mirror_test', 'hydro', [5]) == 0
+    write_usage(db_path, '2019-01-08')
+    assert mirror1.sync('mirror_test', 'hydro', [5]) == 6
+
+    state = pd.read_csv(os.path.join(mirror1.path, state_file))
+    assert len(state) == 2
+
+    ts1 = mirror1.read([5], ['123', '456'], '2019-01-01', '2019-01-08')
+    assert len(ts1) == 16
+    assert not ts1.duplicated(['ExtSiteID', 'DateTime']).any()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the shared store lock-file protocol across worker processes.
+"""
+import os
+import time
+import threading
+import multiprocessing as mp
+import pandas as pd
+import store
+from store import SharedStore
+
+##########################################
+### Functions
+
+
+def build_in_worker(args):
+    path, key, delay = args
+    store1 = SharedStore(path)
+
+    def build():
+        with open(os.path.join(path, 'builds.txt'), 'a') as f:
+            f.write(str(os.getpid()) + '\n')
+        time.sleep(delay)
+        return pd.DataFrame({'site': pd.Categorical(['a', 'b']), 'flow': [1.5, 2.5]})
+
+    df = store1.get_or_build(key, build, max_age=60)
+    return df['flow'].sum()
+
+
+def build_count(path):
+    with open(os.path.join(path, 'builds.txt')) as f:
+        return len(f.read().split())
+
+
+def test_one_build_across_processes(tmp_path):
+    path = str(tmp_path)
+    with mp.get_context('spawn').Pool(4) as pool:
+        results = pool.map(build_in_worker, [(path, 'lf_site_summ|2019-01-01|2019-01-15', 1)] * 8)
+
+    assert results == [4.0] * 8
+    assert build_count(path) == 1
+    assert not [n for n in os.listdir(path) if n.endswith(('.lock', '.tmp'))]
+
+
+def test_stale_frame_served_during_rebuild(tmp_path):
+    path = str(tmp_path)
+    key = 'band_ts|a|1|2019-01-01|2019-01-15'
+    store1 = SharedStore(path)
+    store1.put(key, pd.DataFrame({'flow': [0.0]}))
+    old = time.time() - 120
+    for name in os.listdir(path):
+        os.utime(os.path.join(path, name), (old, old))
+
+    with mp.get_context('spawn').Pool(3) as pool:
+        results = pool.map(build_in_worker, [(path, key, 3)] * 3, chunksize=1)
+
+    ## One worker rebuilds, the others get the previous frame without waiting
+    assert sorted(results) == [0.0, 0.0, 4.0]
+    assert build_count(path) == 1
+    assert store1.get(key)['flow'].sum() == 4.0
+
+
+def test_prune(tmp_path):
+    store1 = SharedStore(str(tmp_path), keep_age=60)
+    store1.put('old', pd.DataFrame({'x': [1]}))
+    store1.put('new', pd.DataFrame({'x': [2]}))
+    old = time.time() - 120
+    os.utime(store1._find('old'), (old, old))
+
+    assert store1.prune() == 1
+    assert store1.get('old') is None
+    assert store1.get('new')['x'][0] == 2
+
+
+def test_long_build_keeps_its_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'lock_timeout', 0.5)
+    path = str(tmp_path)
+    builds = []
+    errors = []
+
+    def build():
+        builds.append(1)
+        time.sleep(1.5)
+        return pd.DataFrame({'x': [len(builds)]})
+
+    def worker():
+        try:
+            SharedStore(path).get_or_build('slow', build)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for t in threads:
+        t.start()
+        time.sleep(0.2)
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert len(builds) == 1
+    assert not [n for n in os.listdir(path) if n.endswith('.lock')]
+
+
+def test_release_keeps_a_lock_taken_over(tmp_path):
+    store1 = SharedStore(str(tmp_path))
+    lock_path, token = store1._acquire('k')
+    with open(lock_path, 'w') as f:
+        f.write('other')
+
+    store1._release(lock_path, token)
+    assert os.path.isfile(lock_path)
+    os.remove(lock_path)
+    store1._release(lock_path, token)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the util data functions that do not need a database.
+"""
+import numpy as np
+import pandas as pd
+from util import downsample_steps
+
+##########################################
+### Functions
+
+
+def step_value(x, y, at):
+    """
+    Value of the step series (shape='hv') at the x positions at.
+    """
+    return y[np.searchsorted(x, at, side='right') - 1]
+
+
+def test_downsample_steps_bucket_ends():
+    rs = np.random.RandomState(1)
+    n = 20000
+    x = np.arange(n)
+    y = np.round(rs.randn(n).cumsum() / 10) + (rs.rand(n) < 0.05) * 5
+
+    max_points = 300
+    x1, y1 = downsample_steps(x, y, max_points)
+    assert len(x1) <= max_points + 1
+    assert x1[0] == x[0] and x1[-1] == x[-1]
+
+    ## Rebuild the buckets of step changes and check the value at each bucket end and just before the next bucket
+    changes = np.flatnonzero(np.r_[True, y[1:] != y[:-1]])
+    changes = np.unique(np.r_[changes, n - 1])
+    buckets = np.array_split(changes, max_points//4)
+    ends = np.array([b[-1] for b in buckets])
+    before_next = np.array([b[0] - 1 for b in buckets[1:]])
+    for at in [ends, before_next]:
+        assert (step_value(x1, y1, x[at]) == y[at]).all()
+
+
+def test_downsample_steps_small_series_unchanged():
+    x = pd.date_range('2019-01-01', periods=10).values
+    y = np.arange(10.0)
+    x1, y1 = downsample_steps(x, y, 100)
+    assert (x1 == x).all() and (y1 == y).all()
@@ -4,19 +4,28 @@ Created on Tue Jan 15 15:59:37 2019
 
 @author: MichaelEK
 """
-from pdsql import mssql
+import os
+import time
+import queue
+import threading
+import warnings
+from bisect import insort, bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError
+from dbpool import rd_sql
 import pandas as pd
 import numpy as np
-from pyproj import Proj, transform
-from hilltoppy import web_service as ws
-from allotools.allocation_ts import allo_ts
+import metrics
+
+## scipy, pyproj, hilltoppy and allotools are slow to import and are imported on first use
 
 ##########################################
 ### Parameters
 
 ## Convert projections
-from_crs = Proj('+proj=tmerc +ellps=GRS80 +lon_0=173 +x_0=1600000 +y_0=10000000 +k_0=0.9996 +lat_0=0 +units=m +no_defs', preserve_units=True)
-to_crs = Proj('+proj=longlat +datum=WGS84')
+from_proj4 = '+proj=tmerc +ellps=GRS80 +lon_0=173 +x_0=1600000 +y_0=10000000 +k_0=0.9996 +lat_0=0 +units=m +no_defs'
+to_proj4 = '+proj=longlat +datum=WGS84'
+_projs = None
 
 sites_table = 'ExternalSite'
 ts_summ_table = 'TSDataNumericDailySumm'
@@ -30,34 +39,434 @@ crc_wap_table = 'CrcWapAllo'
 
 sites_cols = ['ExtSiteID', 'ExtSiteName', 'NZTMX', 'NZTMY']
 
+site_types = ['LowFlow', 'Residual']
+data_source = ['Telemetered', 'Correlated from Telem', 'Gauged', 'Manually Calculated', 'GW manual']
+restr_type = ['No', 'Partial', 'Full', 'Deactivated']
+
+## Compact site summary schema
+summ_categories = {'Site type': site_types, 'Data source': data_source, 'Restriction category': restr_type}
+epoch = pd.Timestamp('1970-01-01')
+
 wq_mtypes_table = 'WQMeasurement'
 wq_summ_table = 'WQDataSumm'
 
 base_url = 'http://wateruse.ecan.govt.nz'
 hts = 'WQAll.hts'
 
+## Concurrent Hilltop requests
+hilltop_workers = 8
+hilltop_timeout = 60
+
+## Allocation and usage summary stages
+allo_usage_workers = 3
+allo_usage_timings = {}
+
+## Local usage mirror (a mirror.UsageMirror), used instead of TSDataNumericDaily when set
+usage_mirror = None
+
+## Materialized daily allocations (an allo_cache.AlloCache), used instead of running allo_ts on every call when set
+allo_cache = None
+
+## Site coordinate cache (set to a csv path to persist it between restarts)
+coord_cache_path = None
+
+_site_coords = None
+_site_coords_lock = threading.Lock()
+
+## Low flow site date cache
+lf_immutable_days = 7
+lf_refresh_age = 600
+
+_lf_caches = {}
+_lf_caches_lock = threading.Lock()
+
+## Indexes of the most recently used summary tables
+frame_index_max = 8
+site_date_memo_max = 64
+
+_frame_indexes = OrderedDict()
+_frame_indexes_lock = threading.Lock()
+
+##########################################
+### Classes
+
+
+class DateRangeCache(object):
+    """
+    Cache of rows by date that only fetches the days not already held. Days older than horizon days are treated as immutable, more recent days are fetched again once they are older than refresh_age seconds. loader must take from_date and to_date strings and return a DataFrame with a date_col. date_func converts a DatetimeIndex to the representation of date_col if that is not datetime, and compact_func is applied to the cached frame after new days are spliced in.
+    """
+    def __init__(self, loader, date_col='Date', horizon=7, refresh_age=600, date_func=None, compact_func=None):
+        self.loader = loader
+        self.date_col = date_col
+        self.horizon = horizon
+        self.refresh_age = refresh_age
+        self.date_func = date_func
+        self.compact_func = compact_func
+        self._data = None
+        self._fetched = pd.Series([], dtype='datetime64[ns]')
+        self._lock = threading.Lock()
+
+    def _missing_days(self, days):
+        now = pd.Timestamp.now()
+        cutoff = now.floor('D') - pd.Timedelta(days=self.horizon)
+        fetched = self._fetched.reindex(days)
+        stale = fetched.isnull() | ((days >= cutoff) & ((now - fetched) > pd.Timedelta(seconds=self.refresh_age)))
+        return days[stale.values]
+
+    def get(self, from_date, to_date):
+        """
+        Return the rows between from_date and to_date (inclusive).
+        """
+        days = pd.date_range(pd.Timestamp(from_date).floor('D'), pd.Timestamp(to_date).floor('D'), freq='D')
+
+        with self._lock:
+            missing = self._missing_days(days)
+            if len(missing) > 0:
+                ## Group the missing days into contiguous runs and fetch each run
+                run_id = np.r_[0, np.cumsum(np.diff(missing.values) != np.timedelta64(1, 'D'))]
+                new_list = []
+                for _, run in pd.Series(missing, index=missing).groupby(run_id):
+                    new1 = self.loader(str(run.iloc[0].date()), str(run.iloc[-1].date()))
+                    new_list.append(new1)
+                new2 = pd.concat(new_list)
+
+                if self._data is None:
+                    self._data = new2
+                else:
+                    keep1 = ~self._data[self.date_col].isin(self._to_col(missing))
+                    self._data = pd.concat([self._data[keep1], new2], sort=False)
+                self._data = self._data.sort_values(self.date_col).reset_index(drop=True)
+                if self.compact_func is not None:
+                    self._data = self.compact_func(self._data)
+
+                fetched1 = pd.Series(pd.Timestamp.now(), index=missing)
+                self._fetched = pd.concat([self._fetched.drop(missing, errors='ignore'), fetched1]).sort_index()
+
+            data = self._data
+
+        dates1 = data[self.date_col]
+        first1, last1 = self._to_col(days[[0, -1]])
+        return data[(dates1 >= first1) & (dates1 <= last1)].copy()
+
+    def _to_col(self, days):
+        if self.date_func is None:
+            return days
+        return self.date_func(days)
+
+
+class DateOverlapIndex(object):
+    """
+    Sorted endpoint index of the FromDate/ToDate intervals of a summary table. positions(start, end) finds the rows active in [start, end] with two binary searches and only checks the smaller of the two candidate sets against the other endpoint.
+    """
+    def __init__(self, ts_summ):
+        self.from_dates = pd.to_datetime(ts_summ['FromDate']).values
+        self.to_dates = pd.to_datetime(ts_summ['ToDate']).values
+        self.from_order = np.argsort(self.from_dates, kind='mergesort')
+        self.to_order = np.argsort(self.to_dates, kind='mergesort')
+        self.from_sorted = self.from_dates[self.from_order]
+        self.to_sorted = self.to_dates[self.to_order]
+        self.n = len(ts_summ)
+
+    def positions(self, start, end):
+        """
+        Sorted row positions of the datasets with FromDate <= end and ToDate >= start.
+        """
+        start = np.datetime64(pd.Timestamp(start))
+        end = np.datetime64(pd.Timestamp(end))
+
+        n_from = np.searchsorted(self.from_sorted, end, side='right')
+        i_to = np.searchsorted(self.to_sorted, start, side='left')
+
+        if n_from <= (self.n - i_to):
+            pos = self.from_order[:n_from]
+            pos = pos[self.to_dates[pos] >= start]
+        else:
+            pos = self.to_order[i_to:]
+            pos = pos[self.from_dates[pos] <= end]
+
+        return np.sort(pos)
+
+
+class SiteDateIndex(object):
+    """
+    Row positions of a site summary frame by date, and a memo of results derived from them such as the map geometry of a date.
+    """
+    def __init__(self, summ):
+        self.dates = summ.groupby('Date', sort=False).indices
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+
+    def positions(self, date):
+        """
+        Sorted row positions of a date.
+        """
+        return self.dates.get(date, np.array([], dtype=int))
+
+    def memo(self, key, func):
+        """
+        Return the cached result of func for key, calling func on a miss.
+        """
+        with self._memo_lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+        result = func()
+        with self._memo_lock:
+            self._memo[key] = result
+            while len(self._memo) > site_date_memo_max:
+                self._memo.popitem(last=False)
+        return result
+
+
+class ExceedanceRanking(object):
+    """
+    The latest usage/allo of each consent, kept in descending order as new usage days arrive so the worst offenders can be returned without sorting the allocation and usage frame.
+    """
+    def __init__(self):
+        self._latest = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def update(self, allo_usage):
+        """
+        Update the ranking from a frame with crc, date, Usage, allo and usage/allo columns. Only the consents whose latest date or usage/allo changed are moved, and consents no longer in the frame are dropped.
+        """
+        df = allo_usage[['crc', 'date', 'Usage', 'allo', 'usage/allo']].dropna()
+        df = df[np.isfinite(df['usage/allo'])]
+        latest = df.sort_values('date', kind='mergesort').drop_duplicates('crc', keep='last')
+        new_latest = {crc: (date, ratio, usage, allo) for crc, date, usage, allo, ratio in latest.itertuples(index=False, name=None)}
+
+        changed = 0
+        with self._lock:
+            for crc in [c for c in self._latest if c not in new_latest]:
+                del self._order[bisect_left(self._order, (-self._latest[crc][1], crc))]
+                del self._latest[crc]
+                changed += 1
+
+            for crc, new1 in new_latest.items():
+                old = self._latest.get(crc)
+                if old is not None:
+                    if old[:2] == new1[:2]:
+                        continue
+                    del self._order[bisect_left(self._order, (-old[1], crc))]
+                insort(self._order, (-new1[1], crc))
+                self._latest[crc] = new1
+                changed += 1
+
+        return changed
+
+    def top(self, n=20):
+        """
+        DataFrame of the n consents with the highest latest usage/allo.
+        """
+        with self._lock:
+            rows = [(crc,) + self._latest[crc] for _, crc in self._order[:n]]
+        top1 = pd.DataFrame(rows, columns=['crc', 'date', 'usage/allo', 'Usage', 'allo'])
+        top1['date'] = pd.to_datetime(top1['date'])
+        return top1.astype({'usage/allo': float, 'Usage': float, 'allo': float})
+
+
 ##########################################
 ### Functions
 
 
+def frame_index(df, index_class):
+    """
+    The index_class index of a DataFrame, built once and kept for the most recently used frames.
+    """
+    key = (index_class.__name__, id(df))
+    with _frame_indexes_lock:
+        if key in _frame_indexes and _frame_indexes[key][0] is df:
+            _frame_indexes.move_to_end(key)
+            return _frame_indexes[key][1]
+
+    index1 = index_class(df)
+
+    with _frame_indexes_lock:
+        _frame_indexes[key] = (df, index1)
+        while len(_frame_indexes) > frame_index_max:
+            _frame_indexes.popitem(last=False)
+
+    return index1
+
+
+def overlap_index(ts_summ):
+    """
+    The DateOverlapIndex of a summary table.
+    """
+    return frame_index(ts_summ, DateOverlapIndex)
+
+
+def site_date_index(summ):
+    """
+    The SiteDateIndex of a site summary frame.
+    """
+    return frame_index(summ, SiteDateIndex)
+
+
+
+def date_to_days(dates):
+    """
+    Convert a date or an array of dates to int32 days since 1970-01-01.
+    """
+    if isinstance(dates, (str, pd.Timestamp)) or np.isscalar(dates):
+        return np.int32((pd.Timestamp(dates).floor('D') - epoch).days)
+    days = (pd.DatetimeIndex(dates).floor('D') - epoch).days.values.astype('int32')
+    if isinstance(dates, pd.Series):
+        return pd.Series(days, index=dates.index, name=dates.name)
+    return days
+
+
+def days_to_date(days):
+    """
+    Convert int32 days since 1970-01-01 back to dates.
+    """
+    dates = epoch + pd.to_timedelta(np.asarray(days, dtype='int64'), unit='D')
+    if isinstance(days, pd.Series):
+        return pd.Series(dates, index=days.index, name=days.name)
+    return dates
+
+
+def compact_summ(df):
+    """
+    Convert a site summary frame to the compact schema: categoricals for the site type, data source, restriction category and ExtSiteID columns, int32 days for Date and downcast numeric columns. Values outside the fixed category sets are kept as extra categories. Applying it again is cheap.
+    """
+    for col, cats in summ_categories.items():
+        if col in df:
+            values = df[col].astype(object)
+            extra = sorted(set(values.dropna().unique()) - set(cats))
+            df[col] = pd.Categorical(values, categories=cats + extra)
+    if 'ExtSiteID' in df and not pd.api.types.is_categorical_dtype(df['ExtSiteID']):
+        df['ExtSiteID'] = df['ExtSiteID'].astype('category')
+    if 'Date' in df and pd.api.types.is_datetime64_any_dtype(df['Date']):
+        df['Date'] = date_to_days(df['Date'])
+    for col in df.select_dtypes(include=['integer']).columns:
+        if col != 'Date':
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    for col in df.select_dtypes(include=['floating']).columns:
+        if col not in ('lon', 'lat'):
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    return df
+
+
+def expand_summ(df):
+    """
+    Copy of a compact site summary frame with the Date column converted back to dates, for display and export.
+    """
+    df = df.copy()
+    if 'Date' in df and pd.api.types.is_integer_dtype(df['Date']):
+        df['Date'] = days_to_date(df['Date'])
+    return df
+
+
+def downsample_steps(x, y, max_points=2000):
+    """
+    Reduce a series drawn with shape='hv' to about max_points points. Points that do not change the step value are dropped first, which leaves the plotted line unchanged. If there are still too many points, the first, minimum, maximum and last point of each of max_points/4 buckets are kept, so the step value at every bucket end is right. Returns the reduced x and y arrays.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= max_points:
+        return x, y
+
+    ## Drop the points that keep the previous step value
+    nan1 = np.isnan(y)
+    keep = np.ones(n, dtype=bool)
+    keep[1:] = ~((y[1:] == y[:-1]) | (nan1[1:] & nan1[:-1]))
+    keep[-1] = True
+    idx = np.flatnonzero(keep)
+
+    ## Keep the ends and the extremes of each bucket
+    if len(idx) > max_points:
+        sel = [n - 1]
+        for b in np.array_split(idx, max(max_points//4, 1)):
+            yb = y[b]
+            sel.extend([b[0], b[-1]])
+            if not np.isnan(yb).all():
+                sel.extend([b[np.nanargmin(yb)], b[np.nanargmax(yb)]])
+        idx = np.unique(sel)
+
+    return x[idx], y[idx]
+
+
+def allo_ts(server, from_date, to_date, freq, groupby, crc_filter=None, **kwargs):
+    """
+    allotools.allocation_ts.allo_ts, imported on the first call.
+    """
+    from allotools.allocation_ts import allo_ts as allo_ts1
+    return allo_ts1(server, from_date, to_date, freq, groupby, crc_filter=crc_filter, **kwargs)
+
+
+def nztm_to_wgs84(x, y):
+    """
+    Project NZTM coordinate arrays to WGS84 in a single call. Returns a tuple of lon and lat arrays.
+    """
+    global _projs
+
+    from pyproj import Proj, transform
+    if _projs is None:
+        _projs = (Proj(from_proj4, preserve_units=True), Proj(to_proj4))
+    lon, lat = transform(_projs[0], _projs[1], np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    return np.asarray(lon), np.asarray(lat)
+
+
+def _load_site_coords():
+    if coord_cache_path is not None and os.path.isfile(coord_cache_path):
+        coords = pd.read_csv(coord_cache_path, index_col='ExtSiteID', dtype={'ExtSiteID': str})
+        ## Files written before the IDs were read as strings can hold duplicate sites
+        return coords[~coords.index.duplicated(keep='last')]
+    return pd.DataFrame(columns=['NZTMX', 'NZTMY', 'lon', 'lat'], index=pd.Index([], name='ExtSiteID'))
+
+
+def site_lonlat(sites):
+    """
+    Add lon and lat columns to a sites DataFrame with ExtSiteID, NZTMX and NZTMY columns. Projected coordinates are cached by ExtSiteID and only new or moved sites are projected again.
+    """
+    global _site_coords
+
+    xy1 = sites[['ExtSiteID', 'NZTMX', 'NZTMY']].drop_duplicates('ExtSiteID').set_index('ExtSiteID')
+
+    with _site_coords_lock:
+        if _site_coords is None:
+            _site_coords = _load_site_coords()
+
+        cached = _site_coords.reindex(xy1.index)
+        stale = (cached['NZTMX'] != xy1['NZTMX']) | (cached['NZTMY'] != xy1['NZTMY'])
+
+        if stale.any():
+            new1 = xy1[stale].copy()
+            new1['lon'], new1['lat'] = nztm_to_wgs84(new1['NZTMX'].values, new1['NZTMY'].values)
+            _site_coords = pd.concat([_site_coords.drop(new1.index, errors='ignore'), new1])
+            _site_coords.index.name = 'ExtSiteID'
+            if coord_cache_path is not None:
+                _site_coords.to_csv(coord_cache_path)
+
+        coords = _site_coords
+
+    sites['lon'] = sites['ExtSiteID'].map(coords['lon']).astype(float)
+    sites['lat'] = sites['ExtSiteID'].map(coords['lat']).astype(float)
+
+    return sites
+
+
 def ecan_ts_summ(server, database, features, mtypes, ctypes, data_codes, data_providers):
     """
 
     """
     ### Get the appropriate dataset/mtype keys
-    datasets1 = mssql.rd_sql(server, database, dataset_table, where_in={'Feature': features, 'MeasurementType': mtypes, 'CollectionType': ctypes, 'DataCode': data_codes, 'DataProvider': data_providers})
-    mtypes1 = mssql.rd_sql(server, database, mtype_table, ['MeasurementType', 'Units'], where_in={'MeasurementType': mtypes})
+    datasets1 = rd_sql(server, database, dataset_table, where_in={'Feature': features, 'MeasurementType': mtypes, 'CollectionType': ctypes, 'DataCode': data_codes, 'DataProvider': data_providers})
+    mtypes1 = rd_sql(server, database, mtype_table, ['MeasurementType', 'Units'], where_in={'MeasurementType': mtypes})
     datasets2 = pd.merge(datasets1, mtypes1, on='MeasurementType')
 
-    wq_mtypes = mssql.rd_sql(server, database, wq_mtypes_table, ['MeasurementID', 'Measurement'], where_in={'Measurement': mtypes})
+    wq_mtypes = rd_sql(server, database, wq_mtypes_table, ['MeasurementID', 'Measurement'], where_in={'Measurement': mtypes})
 
     ### Get the summary data
-    summ1 = mssql.rd_sql(server, database, ts_summ_table, ['ExtSiteID', 'DatasetTypeID', 'Min', 'Median', 'Mean', 'Max', 'Count', 'FromDate', 'ToDate'], where_in={'DatasetTypeID': datasets1.DatasetTypeID.tolist()})
+    summ1 = rd_sql(server, database, ts_summ_table, ['ExtSiteID', 'DatasetTypeID', 'Min', 'Median', 'Mean', 'Max', 'Count', 'FromDate', 'ToDate'], where_in={'DatasetTypeID': datasets1.DatasetTypeID.tolist()})
     summ2 = pd.merge(summ1, datasets2, on='DatasetTypeID')
 
     if not wq_mtypes.empty:
         wq_mtypes.rename(columns={'Measurement': 'MeasurementType'}, inplace=True)
-        wq_summ1 = mssql.rd_sql(server, database, wq_summ_table, ['ExtSiteID', 'MeasurementID', 'Units', 'FromDate', 'ToDate'], where_in={'MeasurementID': wq_mtypes.MeasurementID.tolist(), 'DataType': ['WQData']})
+        wq_summ1 = rd_sql(server, database, wq_summ_table, ['ExtSiteID', 'MeasurementID', 'Units', 'FromDate', 'ToDate'], where_in={'MeasurementID': wq_mtypes.MeasurementID.tolist(), 'DataType': ['WQData']})
         wq_summ1['CollectionType'] = 'Manual Field'
         wq_summ1['DataCode'] = 'Primary'
         wq_summ1['DataProvider'] = 'ECan'
@@ -93,7 +502,7 @@ def app_ts_summ(server, database, features, mtypes, ctypes, data_codes, data_pro
     ecan_summ['Dataset Name'] = ecan_summ.Feature + ' - ' + ecan_summ.MeasurementType + ' - ' + ecan_summ.CollectionType + ' - ' + ecan_summ.DataCode + ' - ' + ecan_summ.DataProvider + ' (' + ecan_summ.Units + ')'
 
     ## Get site info
-    sites = mssql.rd_sql(server, database, sites_table, sites_cols)
+    sites = rd_sql(server, database, sites_table, sites_cols)
     sites['NZTMX'] = sites['NZTMX'].astype(int)
     sites['NZTMY'] = sites['NZTMY'].astype(int)
 
@@ -103,11 +512,7 @@ def app_ts_summ(server, database, features, mtypes, ctypes, data_codes, data_pro
     sites['hover'] = sites.ExtSiteID + '<br>' + sites.ExtSiteName.str.strip()
 
     # Convert projections
-    xy1 = list(zip(sites['NZTMX'], sites['NZTMY']))
-    x, y = list(zip(*[transform(from_crs, to_crs, x, y) for x, y in xy1]))
-
-    sites['lon'] = x
-    sites['lat'] = y
+    sites = site_lonlat(sites)
 
     ## Combine with everything
     ts_summ = pd.merge(sites, ecan_summ, on='ExtSiteID')
@@ -127,8 +532,8 @@ def sel_ts_summ(ts_summ, features, mtypes, ctypes, data_codes, data_providers, s
     if isinstance(data_providers, str):
         data_providers = [data_providers]
 
-    date_bool = ((ts_summ.FromDate >= start_date) & (ts_summ.FromDate <= end_date)) | ((ts_summ.ToDate >= start_date) & (ts_summ.ToDate <= end_date)) | ((ts_summ.FromDate <= start_date) & (ts_summ.ToDate >= end_date))
-    df = ts_summ[date_bool & ts_summ.Feature.isin(features) & ts_summ.MeasurementType.isin(mtypes) & ts_summ.CollectionType.isin(ctypes) & ts_summ.DataCode.isin(data_codes) & ts_summ.DataProvider.isin(data_providers)].copy()
+    ts_summ1 = ts_summ.iloc[overlap_index(ts_summ).positions(start_date, end_date)]
+    df = ts_summ1[ts_summ1.Feature.isin(features) & ts_summ1.MeasurementType.isin(mtypes) & ts_summ1.CollectionType.isin(ctypes) & ts_summ1.DataCode.isin(data_codes) & ts_summ1.DataProvider.isin(data_providers)].copy()
 
     df['FromDate'] = df['FromDate'].dt.date.astype(str)
     df['ToDate'] = df['ToDate'].dt.date.astype(str)
@@ -139,7 +544,62 @@ def sel_ts_summ(ts_summ, features, mtypes, ctypes, data_codes, data_providers, s
     return df
 
 
-def ecan_ts_data(server, database, site_ts_summ, from_date, to_date, dtl_method=None):
+def _hilltop_get(site, mtype, from_date, to_date, dtl_method=None):
+    from hilltoppy import web_service as ws
+    with metrics.timer('hilltop', mtype) as t:
+        ts0 = ws.get_data(base_url, hts, site, mtype, from_date, to_date, dtl_method=dtl_method)
+        t.rows = len(ts0)
+    return ts0
+
+
+def hilltop_ts_data(sites, mtype, from_date, to_date, dtl_method=None, max_workers=hilltop_workers, timeout=hilltop_timeout):
+    """
+    Get the Hilltop data for many sites with at most max_workers concurrent requests. Sites that fail or take longer than timeout seconds are left out. A timed out request no longer counts against max_workers, so the queued sites start without waiting for it. Returns a tuple of the list of site DataFrames (in the order of sites) and a dict of site to exception for the failed sites.
+    """
+    done_queue = queue.Queue()
+
+    def get_site(site):
+        try:
+            done_queue.put((site, _hilltop_get(site, mtype, from_date, to_date, dtl_method), None))
+        except Exception as err:
+            done_queue.put((site, None, err))
+
+    queued = list(OrderedDict.fromkeys(sites))
+    running = {}
+    results = {}
+    failed = {}
+
+    while queued or running:
+        while queued and len(running) < max_workers:
+            site = queued.pop(0)
+            running[site] = time.time()
+            threading.Thread(target=get_site, args=(site,), name='hilltop-' + str(site), daemon=True).start()
+
+        wait1 = max(min(running.values()) + timeout - time.time(), 0)
+        try:
+            site, ts0, err = done_queue.get(timeout=wait1)
+            ## Results of requests that already timed out are dropped
+            if site in running:
+                del running[site]
+                if err is None:
+                    results[site] = ts0
+                else:
+                    failed[site] = err
+        except queue.Empty:
+            pass
+
+        now = time.time()
+        for site, start1 in list(running.items()):
+            if (now - start1) > timeout:
+                del running[site]
+                failed[site] = TimeoutError('Hilltop request for ' + str(site) + ' took longer than ' + str(timeout) + ' seconds')
+
+    ts_list = [results[s] for s in sites if s in results]
+
+    return ts_list, failed
+
+
+def ecan_ts_data(server, database, site_ts_summ, from_date, to_date, dtl_method=None, concurrent=True, max_workers=hilltop_workers, timeout=hilltop_timeout):
     """
 
     """
@@ -147,72 +607,186 @@ def ecan_ts_data(server, database, site_ts_summ, from_date, to_date, dtl_method=
     sites1 = site_ts_summ.ExtSiteID.unique().tolist()
 
     if dataset1 < 10000:
-        ts1 = mssql.rd_sql(server, database, ts_table, ['ExtSiteID', 'DateTime', 'Value'], where_in={'DatasetTypeID': [dataset1], 'ExtSiteID': sites1}, from_date=from_date, to_date=to_date, date_col='DateTime')
+        ts1 = rd_sql(server, database, ts_table, ['ExtSiteID', 'DateTime', 'Value'], where_in={'DatasetTypeID': [dataset1], 'ExtSiteID': sites1}, from_date=from_date, to_date=to_date, date_col='DateTime')
     else:
-        ts_list = []
         mtype = site_ts_summ.MeasurementType.iloc[0]
-        for s in sites1:
-            ts0 = ws.get_data(base_url, hts, s, mtype, from_date, to_date, dtl_method=dtl_method)
-            ts_list.append(ts0)
+        if concurrent:
+            ts_list, failed = hilltop_ts_data(sites1, mtype, from_date, to_date, dtl_method, max_workers, timeout)
+            if failed:
+                warnings.warn('Hilltop data could not be retrieved for sites: ' + ', '.join(str(s) for s in failed))
+        else:
+            ts_list = []
+            for s in sites1:
+                ts0 = _hilltop_get(s, mtype, from_date, to_date, dtl_method)
+                ts_list.append(ts0)
+        if not ts_list:
+            return pd.DataFrame(columns=['ExtSiteID', 'DateTime', 'Value'])
         ts1 = pd.concat(ts_list).reset_index().drop('Measurement', axis=1)
         ts1.rename(columns={'Site': 'ExtSiteID'}, inplace=True)
 
     return ts1
 
 
-def lf_site_summ(server, database, from_date, to_date):
-    site_summ = mssql.rd_sql(server, database, lf_site_table, ['site', 'date', 'site_type', 'flow_method', 'days_since_flow_est', 'flow', 'crc_count', 'min_trig', 'max_trig', 'restr_category'], from_date=from_date, to_date=to_date, date_col='date', rename_cols=['ExtSite', 'Date', 'Site type', 'Data source', 'Days since last estimate', 'Flow or water level', 'Crc count', 'Min trigger', 'Max trigger', 'Restriction category'])
-    sites1 = site_summ.ExtSiteID.unique().tolist()
+def lf_site_rows(server, database, from_date, to_date):
+    """
+    Read the LowFlowRestrSite rows between from_date and to_date.
+    """
+    site_summ = rd_sql(server, database, lf_site_table, ['site', 'date', 'site_type', 'flow_method', 'days_since_flow_est', 'flow', 'crc_count', 'min_trig', 'max_trig', 'restr_category'], from_date=from_date, to_date=to_date, date_col='date', rename_cols=['ExtSiteID', 'Date', 'Site type', 'Data source', 'Days since last estimate', 'Flow or water level', 'Crc count', 'Min trigger', 'Max trigger', 'Restriction category'])
+    site_summ['Date'] = pd.to_datetime(site_summ['Date'])
+    return compact_summ(site_summ)
+
+
+def lf_site_cache(server, database):
+    """
+    The DateRangeCache of LowFlowRestrSite rows for a server and database.
+    """
+    with _lf_caches_lock:
+        if (server, database) not in _lf_caches:
+            _lf_caches[(server, database)] = DateRangeCache(lambda from_date, to_date: lf_site_rows(server, database, from_date, to_date), 'Date', lf_immutable_days, lf_refresh_age, date_to_days, compact_summ)
+        return _lf_caches[(server, database)]
+
+
+def lf_site_summ(server, database, from_date, to_date, use_cache=True):
+    """
+
+    """
+    if use_cache:
+        site_summ = lf_site_cache(server, database).get(from_date, to_date)
+    else:
+        site_summ = lf_site_rows(server, database, from_date, to_date)
+    sites1 = site_summ.ExtSiteID.astype(str).unique().tolist()
+    site_summ['ExtSiteID'] = site_summ['ExtSiteID'].astype(str)
 
     ## Get site info
-    sites = mssql.rd_sql(server, database, sites_table, ['ExtSiteID', 'ExtSiteName', 'NZTMX', 'NZTMY'], where_in={'ExtSiteID': sites1})
+    sites = rd_sql(server, database, sites_table, ['ExtSiteID', 'ExtSiteName', 'NZTMX', 'NZTMY'], where_in={'ExtSiteID': sites1})
     sites['NZTMX'] = sites['NZTMX'].astype(int)
     sites['NZTMY'] = sites['NZTMY'].astype(int)
 
     sites.loc[sites.ExtSiteName.isnull(), 'ExtSiteName'] = ''
 
     # Convert projections
-    xy1 = list(zip(sites['NZTMX'], sites['NZTMY']))
-    x, y = list(zip(*[transform(from_crs, to_crs, x, y) for x, y in xy1]))
-
-    sites['lon'] = x
-    sites['lat'] = y
+    sites = site_lonlat(sites)
 
     combo = pd.merge(sites, site_summ, on='ExtSiteID')
 
     # Hover text
-    combo['hover'] = combo.ExtSiteID + '<br>' + combo.ExtSiteName.str.strip() + '<br>' + combo['Data source'] + ' ' + combo['Days since last estimate'].astype(str) + ' day(s) ago'
+    combo['hover'] = combo.ExtSiteID + '<br>' + combo.ExtSiteName.str.strip() + '<br>' + combo['Data source'].astype(str) + ' ' + combo['Days since last estimate'].astype(str) + ' day(s) ago'
 
-    return combo
+    return compact_summ(combo)
 
 
-def app_allo_usage_summ(server, database, from_date, to_date, site_summ, usage_ts_summ):
+def apportion_usage(crc_wap, usage):
     """
-
+    Split the daily usage of each wap equally between the consents on it and sum it per consent and date. crc_wap has crc and wap columns and usage has wap, date and Usage columns. The split is a sparse crc x wap weight matrix times a dense wap x date usage matrix, so the crc x wap x date long frame is never built. Returns a DataFrame of crc, date and Usage for the consent/dates with any usage record.
     """
-    date_bool = ((usage_ts_summ.FromDate >= from_date) & (usage_ts_summ.FromDate <= to_date)) | ((usage_ts_summ.ToDate >= from_date) & (usage_ts_summ.ToDate <= to_date)) | ((usage_ts_summ.FromDate <= from_date) & (usage_ts_summ.ToDate >= to_date))
-    usage_ts_summ1 = usage_ts_summ[date_bool].copy()
+    from scipy import sparse
+
+    crc_codes, crcs = pd.factorize(crc_wap['crc'])
+    wap_codes, waps = pd.factorize(crc_wap['wap'])
+    crcs_per_wap = np.bincount(wap_codes, minlength=len(waps))
+
+    weights = sparse.csr_matrix((1.0/crcs_per_wap[wap_codes], (crc_codes, wap_codes)), shape=(len(crcs), len(waps)))
+    links = sparse.csr_matrix((np.ones(len(wap_codes)), (crc_codes, wap_codes)), shape=(len(crcs), len(waps)))
+
+    ## Dense wap x date usage, averaging duplicate records of a wap and date
+    usage1 = usage[usage['wap'].isin(waps)]
+    u_waps = waps.get_indexer(usage1['wap'])
+    date_codes, dates = pd.factorize(usage1['date'], sort=True)
+    sums = np.zeros((len(waps), len(dates)))
+    counts = np.zeros((len(waps), len(dates)))
+    np.add.at(sums, (u_waps, date_codes), np.nan_to_num(usage1['Usage'].values.astype(float)))
+    np.add.at(counts, (u_waps, date_codes), 1)
+    use_mat = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+    crc_usage = np.asarray(weights.dot(use_mat))
+    has_usage = np.asarray(links.dot((counts > 0).astype(float))) > 0
+
+    rows, cols = np.nonzero(has_usage)
+    ts3 = pd.DataFrame({'crc': np.asarray(crcs)[rows], 'date': np.asarray(dates)[cols], 'Usage': crc_usage[rows, cols].round(3)})
+
+    return ts3
 
-    lf_crc = mssql.rd_sql(server, database, lf_crc_table, ['site', 'band_num', 'date', 'crc'], where_in={'site': site_summ.ExtSiteID.unique().tolist()}, from_date=from_date, to_date=to_date, date_col='date')
-    lf_crc['date'] = pd.to_datetime(lf_crc['date'])
 
-    crc_wap = mssql.rd_sql(server, database, crc_wap_table, ['crc', 'wap'], where_in={'crc': lf_crc.crc.unique().tolist(), 'wap': usage_ts_summ1.ExtSiteID.unique().tolist()}).drop_duplicates()
+def _timed_call(func, kwargs):
+    start1 = time.time()
+    result = func(**kwargs)
+    return result, time.time() - start1
 
-    allo1 = allo_ts(server, from_date, to_date, 'D', 'daily volume', crc_filter={'crc': lf_crc.crc.unique().tolist()}).reset_index()
-    allo2 = (allo1.groupby(['crc', 'date'])['allo'].sum()/24/60/60).reset_index()
 
-    ## Get usage data
-    ts1 = mssql.rd_sql(server, database, ts_table, ['ExtSiteID', 'DateTime', 'Value'], where_in={'DatasetTypeID': usage_ts_summ1.DatasetTypeID.unique().tolist(), 'ExtSiteID': crc_wap.wap.unique().tolist()}, from_date=from_date, to_date=to_date, date_col='DateTime')
-    ts1['Value'] = ts1['Value']/24/60/60
-    ts1.rename(columns={'ExtSiteID': 'wap', 'DateTime': 'date', 'Value': 'Usage'}, inplace=True)
-    ts1['date'] = pd.to_datetime(ts1['date'])
+def run_stages(stages, max_workers=4):
+    """
+    Run a dict of stage name to a tuple of (function, list of dependency stage names). Each function is called with the results of its dependencies as keyword arguments and stages whose dependencies are done run concurrently. Returns a tuple of the dict of stage results and the dict of stage run times in seconds.
+    """
+    remaining = dict(stages)
+    running = {}
+    results = {}
+    timings = {}
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        while remaining or running:
+            for name, (func, deps) in list(remaining.items()):
+                if all(d in results for d in deps):
+                    running[executor.submit(_timed_call, func, {d: results[d] for d in deps})] = name
+                    del remaining[name]
+            if not running:
+                raise ValueError('Stages have missing or circular dependencies: ' + ', '.join(remaining))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                results[name], timings[name] = f.result()
+
+    return results, timings
 
-    ts2 = pd.merge(crc_wap, ts1, on='wap')
 
-    count1 = ts2.groupby(['wap', 'date']).crc.transform('count')
-    ts2['Usage'] = (ts2['Usage']/count1).round(3)
+def app_allo_usage_summ(server, database, from_date, to_date, site_summ, usage_ts_summ):
+    """
 
-    ts3 = ts2.groupby(['crc', 'date'])['Usage'].sum().reset_index()
+    """
+    usage_ts_summ1 = usage_ts_summ.iloc[overlap_index(usage_ts_summ).positions(from_date, to_date)].copy()
+
+    def get_lf_crc():
+        lf_crc = rd_sql(server, database, lf_crc_table, ['site', 'band_num', 'date', 'crc'], where_in={'site': site_summ.ExtSiteID.unique().tolist()}, from_date=from_date, to_date=to_date, date_col='date')
+        lf_crc['date'] = pd.to_datetime(lf_crc['date'])
+        return lf_crc
+
+    def get_crc_wap(lf_crc):
+        return rd_sql(server, database, crc_wap_table, ['crc', 'wap'], where_in={'crc': lf_crc.crc.unique().tolist(), 'wap': usage_ts_summ1.ExtSiteID.unique().tolist()}).drop_duplicates()
+
+    def get_allo(lf_crc):
+        with metrics.timer('allo_ts', 'daily volume') as t:
+            if allo_cache is not None:
+                allo1 = allo_cache.daily_allo(server, database, lf_crc.crc.unique().tolist(), from_date, to_date)
+            else:
+                allo1 = allo_ts(server, from_date, to_date, 'D', 'daily volume', crc_filter={'crc': lf_crc.crc.unique().tolist()}).reset_index()
+            t.rows = len(allo1)
+        return (allo1.groupby(['crc', 'date'])['allo'].sum()/24/60/60).reset_index()
+
+    def get_usage(crc_wap):
+        if usage_mirror is not None:
+            ts1 = usage_mirror.read(usage_ts_summ1.DatasetTypeID.unique().tolist(), crc_wap.wap.unique().tolist(), from_date, to_date)
+        else:
+            ts1 = rd_sql(server, database, ts_table, ['ExtSiteID', 'DateTime', 'Value'], where_in={'DatasetTypeID': usage_ts_summ1.DatasetTypeID.unique().tolist(), 'ExtSiteID': crc_wap.wap.unique().tolist()}, from_date=from_date, to_date=to_date, date_col='DateTime')
+        ts1['Value'] = ts1['Value']/24/60/60
+        ts1.rename(columns={'ExtSiteID': 'wap', 'DateTime': 'date', 'Value': 'Usage'}, inplace=True)
+        ts1['date'] = pd.to_datetime(ts1['date'])
+        return ts1
+
+    ## Read everything, with the allocation and usage reads running at the same time
+    stages = {'lf_crc': (get_lf_crc, []),
+              'crc_wap': (get_crc_wap, ['lf_crc']),
+              'allo': (get_allo, ['lf_crc']),
+              'usage': (get_usage, ['crc_wap'])}
+
+    results, timings = run_stages(stages, allo_usage_workers)
+    allo_usage_timings.clear()
+    allo_usage_timings.update(timings)
+
+    lf_crc = results['lf_crc']
+    crc_wap = results['crc_wap']
+    allo2 = results['allo']
+    ts1 = results['usage']
+
+    ts3 = apportion_usage(crc_wap, ts1)
 
     ## Combine
 
@@ -225,6 +799,3 @@ def app_allo_usage_summ(server, database, from_date, to_date, site_summ, usage_t
 
 
 
-
-
-#latest1 = allo_usage1.dropna().groupby('crc').last().sort_values('usage/allo', ascending=False).reset_index()